@@ -0,0 +1,13 @@
+"""Host-side simulation of ``zadm.py``.
+
+* :mod:`sim.stubs`  CPython stand-ins for the Zerynth modules and builtins,
+  including a flash model behind ``fota`` (in RAM or in a file)
+* :mod:`sim.loader` loads ``zadm.py`` against the stand-ins
+* :mod:`sim.adm`    local mock ADM with latency and loss injection
+* :mod:`sim.cbor`   host codec of the compact encoding
+* :mod:`sim.lzss`   host codec of compressed FOTA images (heatshrink format)
+* :mod:`sim.bench`  benchmark suite: ``python -m sim.bench --quick``
+* :mod:`sim.fleet`  fleet load generator: ``python -m sim.fleet --devices 1000``
+
+Behaviour tests built on the harness are in ``tests/``: ``python -m pytest tests``.
+"""
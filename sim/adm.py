@@ -0,0 +1,557 @@
+"""Local mock ADM speaking the device protocol of ``zadm.py``.
+
+It accepts logins, relays RPC ``CALL`` messages and collects their ``RETN``
+replies, records ``EVNT``/``NTFY``/``HTBM`` traffic and drives FOTA updates
+(full, delta when ``delta`` is set, or compressed when ``lz`` is set).
+Latency (one-way, with jitter) is injected on both directions without limiting
+throughput, and ``drop`` is the per-message probability of killing the link to
+emulate a lossy radio. :meth:`MockADM.freeze` turns a link half open: the
+connection stays up but nothing goes through it any more.
+"""
+
+import base64
+import hashlib
+import json
+import random
+import socket
+import threading
+import time
+import zlib
+
+from . import cbor
+from . import lzss
+
+
+def now():
+    return time.monotonic()
+
+
+def block_crc(i, data):
+    """crc32 of the block index (4 bytes, big endian) followed by the block."""
+    return zlib.crc32(data, zlib.crc32(i.to_bytes(4, "big")))
+
+
+def block_digest(image, chunk):
+    """Incremental FOTA digest: xor of the crcs of all blocks."""
+    d = 0
+    for i in range(0, (len(image) + chunk - 1) // chunk):
+        d ^= block_crc(i, image[i * chunk:(i + 1) * chunk])
+    return d
+
+
+class Session():
+    """One connected device, seen from the ADM."""
+
+    def __init__(self, adm, conn, addr):
+        self.adm = adm
+        self.conn = conn
+        self.addr = addr
+        self.login = None
+        self.uid = None
+        self.alive = True
+        self.rfile = conn.makefile("rb")
+        self._wlock = threading.Lock()
+        self._out = []
+        self._outcv = threading.Condition()
+        self._in = []
+        self._incv = threading.Condition()
+        self.ota = None
+        self.enc = False
+        self.frozen = False
+
+    # transport
+
+    def _delay(self):
+        d = self.adm.latency
+        if self.adm.jitter:
+            d += random.uniform(0, self.adm.jitter)
+        return d / 1000
+
+    def _lost(self):
+        return self.adm.drop and random.random() < self.adm.drop
+
+    def send(self, msg):
+        if self.enc:
+            self.send_raw(cbor.frame(msg))
+        else:
+            self.send_raw((json.dumps(msg) + "\n").encode())
+
+    def send_raw(self, data):
+        if self.frozen:
+            return
+        if self.adm.direct:
+            try:
+                with self._wlock:
+                    self.conn.sendall(data)
+                self.adm.count("tx_bytes", len(data))
+            except OSError:
+                self.close()
+            return
+        with self._outcv:
+            self._out.append((now() + self._delay(), data))
+            self._outcv.notify()
+
+    def _sender(self):
+        while self.alive:
+            with self._outcv:
+                while self.alive and not self._out:
+                    self._outcv.wait(0.5)
+                if not self.alive:
+                    return
+                due, data = self._out[0]
+                wait = due - now()
+                if wait > 0:
+                    self._outcv.wait(wait)
+                    continue
+                self._out.pop(0)
+            if self._lost():
+                self.close()
+                return
+            try:
+                with self._wlock:
+                    self.conn.sendall(data)
+                self.adm.count("tx_bytes", len(data))
+            except OSError:
+                self.close()
+                return
+
+    def _reader(self):
+        while self.alive:
+            try:
+                first = self.rfile.read(1)
+                if first == b"\x03":
+                    hdr = self.rfile.read(2)
+                    line = first + hdr + self.rfile.read((hdr[0] << 8) | hdr[1])
+                elif first:
+                    line = first + self.rfile.readline()
+                else:
+                    line = b""
+            except (OSError, ValueError, IndexError):
+                line = b""
+            if not line:
+                self.close()
+                return
+            if self.frozen:
+                continue
+            self.adm.count("rx_bytes", len(line))
+            try:
+                if line[0] == 3:
+                    msg = cbor.decode(line, 3)[0]
+                    self.adm.count("rx_cbor", 1)
+                else:
+                    msg = json.loads(line)
+            except ValueError:
+                self.adm.count("rx_bad", 1)
+                continue
+            if self.adm.direct:
+                self._dispatch(msg)
+                continue
+            with self._incv:
+                self._in.append((now() + self._delay(), msg))
+                self._incv.notify()
+
+    def _handler(self):
+        while self.alive:
+            with self._incv:
+                while self.alive and not self._in:
+                    self._incv.wait(0.5)
+                if not self.alive:
+                    return
+                due, msg = self._in[0]
+                wait = due - now()
+                if wait > 0:
+                    self._incv.wait(wait)
+                    continue
+                self._in.pop(0)
+            if self._lost():
+                self.close()
+                return
+            self._dispatch(msg)
+
+    def _dispatch(self, msg):
+        try:
+            self.handle(msg)
+        except Exception as e:
+            self.adm.count("handler_errors", 1)
+            self.adm.log("handler error", self.uid, repr(e))
+
+    def start(self):
+        # without latency or loss to inject, the reader thread handles messages and replies
+        # directly: one thread per session lets a fleet of devices connect to one ADM
+        fns = (self._reader,) if self.adm.direct else (self._reader, self._sender, self._handler)
+        for fn in fns:
+            threading.Thread(target=fn, daemon=True).start()
+
+    def close(self):
+        if not self.alive:
+            return
+        self.alive = False
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+        with self._outcv:
+            self._outcv.notify_all()
+        with self._incv:
+            self._incv.notify_all()
+        self.adm._closed(self)
+
+    # protocol
+
+    def handle(self, msg):
+        if self.login is None:
+            self.on_login(msg)
+            return
+        cmd = msg.get("cmd")
+        self.adm.count("rx_" + str(cmd), 1)
+        if cmd == "RETN":
+            self.adm._retn(self, msg)
+        elif cmd == "EVNT" or cmd == "EVNB":
+            self.adm._event(self, msg)
+        elif cmd == "NTFY":
+            self.adm._event(self, msg)
+        elif cmd == "PING":
+            self.send({"cmd": "PONG"})
+        elif cmd == "OTA":
+            if self.ota is not None:
+                self.ota.on_device(msg.get("payload", {}))
+            else:
+                self.adm._ota_idle(self, msg.get("payload", {}))
+
+    def on_login(self, msg):
+        self.login = msg
+        self.uid = msg.get("uid")
+        if self.adm.reject and self.uid in self.adm.reject:
+            self.send({"err": "unauthorized"})
+            self.close()
+            return
+        reply = {"ts": int(time.time() * 1000)}
+        if self.adm.htbm:
+            reply["htbm"] = self.adm.htbm
+        if self.adm.compact and "cbor" in msg.get("enc", ()):
+            reply["enc"] = "cbor"
+        if self.adm.pings and "ping" in msg:
+            reply["ping"] = 1
+        job = self.adm._ota.get(self.uid)
+        resume = False
+        if job is not None and job.ok is None and "resume" in msg:
+            if self.adm.resume and job.matches(msg["resume"]):
+                reply["resume"] = 1
+            resume = True
+        self.send(reply)
+        self.enc = reply.get("enc") == "cbor"
+        self.adm._logged(self)
+        if resume:
+            job.s = self
+            self.ota = job
+            job.resumes += 1
+            if "resume" not in reply:
+                # ADM without resume support, or other images: start over, the device
+                # keeps what it has if the images are the same
+                job.begin()
+
+    def call(self, method, args=(), ret=True):
+        return self.adm.call(self.uid, method, args, ret)
+
+
+class OtaJob():
+    """Server side of a FOTA update for one session."""
+
+    def __init__(self, session, bc, vm=b"", chunk=512):
+        self.s = session
+        self.images = {"b": bc, "v": vm}
+        self.chunk = chunk
+        rec = session.adm.fota_record
+        self.bcslot = 1 - rec[4] if rec else 1
+        self.vmslot = 1 - rec[1] if rec else 1
+        self.done = threading.Event()
+        self.ok = None
+        self.reason = None
+        self.blocks = 0
+        self.bytes = 0
+        self.t0 = None
+        self.t1 = None
+        self.resumes = 0
+        self.unchanged = 0
+        self.z = {} # compressed images, by part
+        self.id = hashlib.md5(bc + vm).hexdigest()[:16]
+
+    def matches(self, r):
+        return (r.get("id") == self.id and r.get("bc") == self.bcslot and r.get("vm") == self.vmslot and r.get("chunk") == self.chunk
+                and r.get("bcsize") == len(self.images["b"]) and r.get("vmsize") == len(self.images["v"]))
+
+    def begin(self):
+        msg = {
+            "cmd": "OTA",
+            "id": self.id,
+            "chunk": self.chunk,
+            "bcsize": len(self.images["b"]),
+            "vmsize": len(self.images["v"]),
+            "bc": self.bcslot,
+            "vm": self.vmslot,
+        }
+        adm = self.s.adm
+        if adm.ota_window and "win" in self.s.login:
+            msg["win"] = adm.ota_window
+        if adm.icrc and self.s.login.get("icrc"):
+            msg["icrc"] = 1
+        if adm.delta and self.s.login.get("delta"):
+            msg["delta"] = 1
+        elif adm.lz and self.s.login.get("lz"):
+            w = min(adm.lz[0], self.s.login["lz"])
+            if not self.z:
+                for t, img in self.images.items():
+                    z = lzss.compress(img, w, adm.lz[1]) if img else b""
+                    # parts that do not shrink are sent as they are
+                    self.z[t] = z if len(z) < len(img) else None
+            msg["lz"] = [w, adm.lz[1]] + [len(self.z[t]) if self.z[t] else 0 for t in "bv"]
+        if self.t0 is None:
+            self.t0 = now()
+        self.s.send(msg)
+
+    def block(self, t, b):
+        img = self.z.get(t) or self.images[t]
+        data = img[b * self.chunk:(b + 1) * self.chunk]
+        self.blocks += 1
+        self.bytes += len(data)
+        if self.s.adm.frames and self.s.login.get("frm"):
+            ftype = 1 if t == "b" else 2
+            self.s.send_raw(bytes((ftype, b >> 8, b & 0xff, len(data) >> 8, len(data) & 0xff)) + data)
+            return
+        if self.s.enc:
+            msg = {"cmd": "OTA", "t": t, "raw": data}
+        else:
+            msg = {"cmd": "OTA", "t": t, "bin": base64.standard_b64encode(data).decode()}
+        if self.s.adm.ota_window:
+            msg["b"] = b
+        self.s.send(msg)
+
+    def blocks_requested(self, t, b, n):
+        order = list(range(b, b + n))
+        if self.s.adm.reorder:
+            order.reverse()
+        for i in order:
+            self.block(t, i)
+
+    def compare(self, t, o, hashes):
+        """Answer the crcs of the running blocks from *o* with a bitmap of the unchanged ones."""
+        img = self.images[t]
+        bits = bytearray((len(hashes) + 7) // 8)
+        for i, h in enumerate(hashes):
+            b = o + i
+            if b * self.chunk < len(img) and block_crc(b, img[b * self.chunk:(b + 1) * self.chunk]) == h:
+                bits[i >> 3] |= 1 << (i & 7)
+                self.unchanged += 1
+        self.s.send({"cmd": "OTA", "t": t, "o": o, "d": bits.hex()})
+
+    def crc(self, t):
+        msg = {"cmd": "OTA", "t": t, "crc": hashlib.md5(self.images[t]).hexdigest()}
+        if self.s.adm.icrc and self.s.login.get("icrc"):
+            msg["icrc"] = "%08x" % block_digest(self.images[t], self.chunk)
+        self.s.send(msg)
+
+    def on_device(self, p):
+        if "ko" in p:
+            self.finish(False, p.get("reason"))
+        elif "h" in p:
+            self.compare(p["t"], p["o"], p["h"])
+        elif "b" in p:
+            self.blocks_requested(p["t"], p["b"], p.get("n", 1))
+        elif "c" in p:
+            self.crc(p["t"])
+        elif "ok" in p:
+            self.finish(True)
+
+    def finish(self, ok, reason=None):
+        self.ok = ok
+        self.reason = reason
+        self.t1 = now()
+        self.s.ota = None
+        self.done.set()
+
+    def throughput(self):
+        """Image bytes per second, or None while the job is running."""
+        if self.t1 is None:
+            return None
+        return sum(len(i) for i in self.images.values()) / max(self.t1 - self.t0, 1e-9)
+
+
+class MockADM():
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0, jitter=0, drop=0, htbm=None, log=False,
+                 ota_window=None, reorder=False, frames=False, resume=False, icrc=False, compact=False,
+                 record_events=True, delta=False, lz=None, pings=True):
+        self.pings = pings
+        self.lz = lz
+        self.delta = delta
+        self.record_events = record_events
+        self.compact = compact
+        self.icrc = icrc
+        self.resume = resume
+        self.frames = frames
+        self.ota_window = ota_window
+        self.reorder = reorder
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.direct = not (latency or jitter or drop)
+        self.htbm = htbm
+        self.reject = set()
+        self.verbose = log
+        self.fota_record = None
+        self.sessions = {}
+        self.logins = 0
+        self.events = []
+        self.counters = {}
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._callid = 0
+        self._ota = {}
+        self._logged_cv = threading.Condition(self._lock)
+        self._srv = socket.socket()
+        self._srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._srv.bind((host, port))
+        self._srv.listen(1024)
+        self.host, self.port = self._srv.getsockname()
+        self._running = True
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def log(self, *args):
+        if self.verbose:
+            print("[adm]", *args)
+
+    def count(self, key, n):
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def _accept(self):
+        while self._running:
+            try:
+                conn, addr = self._srv.accept()
+            except OSError:
+                return
+            if not self._running:
+                conn.close()
+                return
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Session(self, conn, addr).start()
+
+    def _logged(self, s):
+        with self._lock:
+            old = self.sessions.get(s.uid)
+            self.sessions[s.uid] = s
+            self.logins += 1
+            self._logged_cv.notify_all()
+        if old is not None and old is not s:
+            old.close()
+        self.log("login", s.uid, s.login)
+        job = self._ota.get(s.uid)
+        if job is not None and job.ok is None and job.s is not s and "resume" not in s.login:
+            # the device rebooted on the new image: confirm it
+            job.s = s
+            if s.login.get("bc") == job.bcslot:
+                s.ota = job
+                s.send({"cmd": "OTA", "ok": 1, "bc": job.bcslot, "vm": s.login.get("vm")})
+
+    def _closed(self, s):
+        with self._lock:
+            if self.sessions.get(s.uid) is s:
+                del self.sessions[s.uid]
+            for cid, c in list(self._calls.items()):
+                if c["uid"] == s.uid and not c["done"].is_set():
+                    c["lost"] = True
+
+    def _retn(self, s, msg):
+        with self._lock:
+            c = self._calls.get(msg.get("id"))
+        if c is None:
+            return
+        c["reply"] = msg
+        c["t1"] = now()
+        c["done"].set()
+
+    def _event(self, s, msg):
+        n = len(msg["payload"]) if msg.get("cmd") == "EVNB" else 1
+        with self._lock:
+            self.counters["events"] = self.counters.get("events", 0) + n
+            if self.record_events:
+                self.events.append((now(), s.uid, msg))
+
+    def _ota_idle(self, s, p):
+        if "ko" in p:
+            self.log("ota failure", s.uid, p)
+
+    # public API
+
+    def wait_login(self, uid, timeout=10):
+        end = now() + timeout
+        with self._lock:
+            while uid not in self.sessions:
+                left = end - now()
+                if left <= 0:
+                    return None
+                self._logged_cv.wait(left)
+            return self.sessions[uid]
+
+    def call(self, uid, method, args=(), ret=True, cid=None):
+        """Send a ``CALL`` and return a handle; ``handle["done"].wait()`` for the reply.
+
+        Passing the *cid* of an earlier call sends it again, as a retry.
+        """
+        with self._lock:
+            if cid is None:
+                self._callid += 1
+                cid = self._callid
+            c = {"id": cid, "uid": uid, "t0": now(), "t1": None, "reply": None,
+                 "done": threading.Event(), "lost": False}
+            self._calls[cid] = c
+            s = self.sessions.get(uid)
+        if s is None:
+            c["lost"] = True
+            c["done"].set()
+            return c
+        s.send({"cmd": "CALL", "method": method, "args": list(args), "id": cid, "ret": ret})
+        return c
+
+    def ota(self, uid, bc, vm=b"", chunk=512):
+        s = self.wait_login(uid)
+        job = OtaJob(s, bc, vm, chunk)
+        self._ota[uid] = job
+        s.ota = job
+        job.begin()
+        return job
+
+    def kill(self, uid=None):
+        """Drop the connection of *uid*, or of every device when *uid* is None."""
+        with self._lock:
+            targets = list(self.sessions.values()) if uid is None else [self.sessions.get(uid)]
+        for s in targets:
+            if s is not None:
+                s.close()
+
+    def freeze(self, uid):
+        """Stop all traffic of *uid* without closing its connection, as a NAT timeout would."""
+        with self._lock:
+            s = self.sessions.get(uid)
+            if s is not None:
+                s.frozen = True
+                # the device logging in again is a new session
+                del self.sessions[uid]
+        return s
+
+    def close(self):
+        self._running = False
+        try:
+            # wakes up the accept thread: a closed socket alone may keep accepting
+            self._srv.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self._srv.close()
+        except OSError:
+            pass
+        self.kill()
@@ -0,0 +1,531 @@
+"""Benchmarks of ``zadm.py`` against the local mock ADM.
+
+Run from the repository root::
+
+    python -m sim.bench [--quick] [--latency MS] [--stack BYTES] [--json]
+
+Each benchmark loads a fresh copy of ``zadm.py`` (see :mod:`sim.loader`) and a
+fresh :class:`sim.adm.MockADM`, for every execution mode of ``Device``:
+
+* ``ota``        FOTA throughput (MB/s) for each transport the ADM can pick
+* ``ota_delta``  FOTA time of an image differing from the running one by a few KB,
+                 full and delta update
+* ``ota_lz``     FOTA time of a bytecode image, sent as is and compressed
+* ``ota_heap``   peak heap growth and garbage left by the received blocks per MB
+                 of firmware, measured in a separate process that runs only the
+                 device (on the VM, garbage is what triggers collections)
+* ``events``     events per second, one ``EVNT`` per event and with ``EventBatcher``
+* ``limits``     events per second reaching the ADM and RPC round trip time while
+                 the application sends events of 4 keys in a loop, with a queue
+                 keeping the latest event of each key, with and without a limit
+                 of 10 events per second per key
+* ``rpc``        round trip time of RPC calls (median and 99th percentile, ms)
+* ``rpc_retry``  round trip time of retried calls of a 20 ms function, with and
+                 without the result cache, and the executions of the function
+* ``reconnect``  time from a dropped link to the next login (ms)
+* ``failover``   time from the drain of the ADM node in use to the login on another
+                 one, after some reconnections, and the hostname lookups made by
+                 the device (two node names, 50 ms per lookup)
+* ``halfopen``   time from a link turned half open to the next login (ms), with
+                 pings every second of silence and a one second read deadline
+* ``ram``        peak RAM of a device logging in and staying connected in each mode,
+                 alone and with 2 RPC workers: the stacks of the threads started by
+                 ``Device.start()`` (one ``--stack`` each) plus the peak of the heap
+                 allocated by the device, measured in a separate process as for
+                 ``ota_heap``. ``heap_kb`` is what stays allocated once connected
+
+``--latency`` adds one-way latency to every message in both directions.
+``--stack`` is the default thread stack of the VM the figures are for (bytes).
+Numbers are for comparing revisions on the same host, not absolute figures.
+"""
+
+import argparse
+import gc as _gc
+import json
+import marshal
+import multiprocessing
+import os
+import statistics
+import sys
+import threading
+import time
+
+from . import loader
+from .adm import MockADM
+from .stubs import fota
+from .stubs import zbuiltins
+from .stubs.zbuiltins import QueueFull
+
+MODES = {
+    "threads": {},
+    "low_res": {"low_res": True},
+    "single": {"single_thread": True},
+}
+
+# ADM options selecting the transport of FOTA blocks
+TRANSPORTS = {
+    "json": {"ota_window": 4, "icrc": True},
+    "frames": {"ota_window": 4, "icrc": True, "frames": True},
+    "cbor": {"ota_window": 4, "icrc": True, "compact": True},
+}
+
+# default stack of a thread started by thread() without a size, as configured in the VM
+STACK = 2048
+
+_uid = [0]
+
+
+def _new_uid():
+    _uid[0] += 1
+    return "bench%d" % _uid[0]
+
+
+def _stop_at_attempt(step):
+    # verify the image but do not reset the device at the end of the update
+    return step != 1
+
+
+def _device(z, adm, **kw):
+    uid = _new_uid()
+    kw.setdefault("fota_callback", _stop_at_attempt)
+    # devices offer the compact encoding only when asked to
+    kw.setdefault("compact", adm.compact)
+    d = z.Device(uid, "tok", ip="127.0.0.1", port=adm.port, **kw)
+    d.start()
+    if adm.wait_login(uid) is None:
+        raise RuntimeError("device %s did not log in" % uid)
+    return uid, d
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench_ota(mode, transport, size, latency):
+    z = loader.load()
+    fota.configure()
+    adm = MockADM(latency=latency, **TRANSPORTS[transport])
+    try:
+        uid, d = _device(z, adm, **MODES[mode])
+        job = adm.ota(uid, os.urandom(size), b"", chunk=512)
+        if not job.done.wait(120):
+            return {"error": "timeout"}
+        if job.reason != "stopped by callback":
+            return {"error": job.reason}
+        secs = job.t1 - job.t0
+        return {"mb_s": round(size / secs / 1e6, 3), "secs": round(secs, 3),
+                "blocks_s": d.stats.get()["ota_bps"], "rx_bytes": d.stats.rx_bytes}
+    finally:
+        adm.close()
+
+
+def bench_ota_delta(mode, delta, size, latency, changed=4096):
+    z = loader.load()
+    flash = fota.configure()
+    base = os.urandom(size)
+    flash.load(flash.bc_addr(flash.bc_slot), base)
+    # a few scattered changes, as left by an edit to the bytecode
+    image = bytearray(base)
+    for i in range(4):
+        o = (i * 2 + 1) * size // 8
+        image[o:o + changed // 4] = os.urandom(changed // 4)
+    adm = MockADM(latency=latency, delta=delta, **TRANSPORTS["frames"])
+    try:
+        uid, d = _device(z, adm, **MODES[mode])
+        job = adm.ota(uid, bytes(image), b"", chunk=512)
+        if not job.done.wait(120):
+            return {"error": "timeout"}
+        if job.reason != "stopped by callback":
+            return {"error": job.reason}
+        return {"secs": round(job.t1 - job.t0, 3), "blocks_sent": job.blocks, "copied": d.stats.ota_copied}
+    finally:
+        adm.close()
+
+
+def _bytecode(size):
+    # marshalled code objects of some modules: an image that compresses like bytecode
+    mods = (json, argparse, multiprocessing, statistics, threading)
+    data = b"".join(marshal.dumps(compile(open(m.__file__).read(), m.__file__, "exec")) for m in mods)
+    return (data * (size // len(data) + 1))[:size]
+
+
+def bench_ota_lz(mode, lz, size, latency):
+    z = loader.load()
+    fota.configure()
+    adm = MockADM(latency=latency, lz=(8, 4) if lz else None, **TRANSPORTS["frames"])
+    try:
+        uid, d = _device(z, adm, **MODES[mode])
+        job = adm.ota(uid, _bytecode(size), b"", chunk=512)
+        if not job.done.wait(120):
+            return {"error": "timeout"}
+        if job.reason != "stopped by callback":
+            return {"error": job.reason}
+        return {"secs": round(job.t1 - job.t0, 3), "bytes_sent": job.bytes}
+    finally:
+        adm.close()
+
+
+def _ota_heap_device(port, uid, kw, out):
+    import tracemalloc
+    z = loader.load()
+    fota.configure()
+    done = threading.Event()
+    peak = [0]
+
+    def callback(step):
+        if step == 1:
+            peak[0] = tracemalloc.get_traced_memory()[1]
+            done.set()
+            return False
+        return True
+
+    d = z.Device(uid, "tok", ip="127.0.0.1", port=port, fota_callback=callback, **kw)
+    # the VM has no reference counting: what a block leaves behind is garbage filling the heap
+    # until a collection. Here it is measured as the memory in use when the block is written,
+    # above the memory in use before its message was read
+    before = [0]
+    garbage = [0]
+    getmsg = d._getmsg
+    write_slot = fota.write_slot
+
+    def _getmsg(line=None):
+        before[0] = tracemalloc.get_traced_memory()[0]
+        return getmsg(line)
+
+    def _write_slot(addr, data):
+        garbage[0] += max(0, tracemalloc.get_traced_memory()[0] - before[0])
+        return write_slot(addr, data)
+
+    d._getmsg = _getmsg
+    fota.write_slot = _write_slot
+    d.start()
+    while not d.logged:
+        time.sleep(0.01)
+    out.put("ready")
+    # the queue feeder thread is running now: from here on the process only runs the device
+    time.sleep(0.001)
+    _gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    done.wait(120)
+    tracemalloc.stop()
+    out.put({"peak": peak[0] - base, "garbage": garbage[0]})
+
+
+def bench_ota_heap(mode, transport, size, latency):
+    adm = MockADM(latency=latency, **TRANSPORTS[transport])
+    ctx = multiprocessing.get_context("spawn")
+    out = ctx.Queue()
+    uid = _new_uid()
+    kw = dict(MODES[mode], compact=adm.compact)
+    p = ctx.Process(target=_ota_heap_device, args=(adm.port, uid, kw, out), daemon=True)
+    p.start()
+    try:
+        if out.get(timeout=30) != "ready":
+            return {"error": "device"}
+        adm.ota(uid, os.urandom(size), b"", chunk=512)
+        r = out.get(timeout=120)
+        return {"peak_kb": round(r["peak"] / 1024, 1), "garbage_kb_per_mb": round(r["garbage"] / 1024 / (size / 1e6), 1)}
+    finally:
+        p.terminate()
+        adm.close()
+
+
+def bench_events(mode, n, latency, batch=False, compact=False):
+    z = loader.load()
+    adm = MockADM(latency=latency, compact=compact)
+    try:
+        uid, d = _device(z, adm, **MODES[mode])
+        b = d.event_batcher(size=16, age=50) if batch else None
+        t0 = time.monotonic()
+        for i in range(n):
+            if b is not None:
+                b.add({"i": i})
+                # a full batch is kept when the queue is full: send it before adding more
+                while len(b.records) >= b.size:
+                    try:
+                        b.flush()
+                    except QueueFull:
+                        time.sleep(0.0005)
+                continue
+            while True:
+                try:
+                    d.send_event({"i": i})
+                    break
+                except QueueFull:
+                    time.sleep(0.0005)
+        if b is not None:
+            while True:
+                try:
+                    b.flush()
+                    break
+                except QueueFull:
+                    time.sleep(0.0005)
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline:
+            got = sum(len(m["payload"]) if m["cmd"] == "EVNB" else 1 for _, _, m in adm.events)
+            if got >= n:
+                break
+            time.sleep(0.005)
+        secs = time.monotonic() - t0
+        return {"events_s": round(got / secs), "writes": d.stats.tx_writes}
+    finally:
+        adm.close()
+
+
+def bench_limits(mode, secs, latency, limited):
+    z = loader.load()
+    adm = MockADM(latency=latency)
+    keys = ("temp", "hum", "press", "lux")
+    limits = dict((k, (10, 2)) for k in keys) if limited else None
+    q = z.OutQueue(sizes=(4, 4), policies=(z.BLOCK, z.KEEP_LATEST), limits=limits)
+    try:
+        uid, d = _device(z, adm, rpc={"echo": lambda x: x}, outq=q, **MODES[mode])
+        rtts = []
+        n = 0
+        c = None
+        t0 = time.monotonic()
+        while time.monotonic() - t0 < secs:
+            d.send_event({"n": n}, keys[n % len(keys)])
+            n += 1
+            if c is None:
+                c = adm.call(uid, "echo", (n,))
+            elif c["done"].is_set():
+                if c["reply"] is None:
+                    return {"error": "call lost"}
+                rtts.append((c["t1"] - c["t0"]) * 1000)
+                c = None
+        got = adm.counters.get("events", 0)
+        return {"events_s": round(got / secs), "app_events_s": round(n / secs),
+                "rpc_p50_ms": round(statistics.median(rtts), 2) if rtts else None}
+    finally:
+        adm.close()
+
+
+def bench_rpc(mode, n, latency):
+    z = loader.load()
+    adm = MockADM(latency=latency)
+    try:
+        uid, d = _device(z, adm, rpc={"echo": lambda x: x}, **MODES[mode])
+        rtts = []
+        for i in range(n):
+            c = adm.call(uid, "echo", (i,))
+            if not c["done"].wait(10) or c["reply"] is None:
+                return {"error": "call %d lost" % i}
+            rtts.append((c["t1"] - c["t0"]) * 1000)
+        return {"p50_ms": round(statistics.median(rtts), 2), "p99_ms": round(_percentile(rtts, 99), 2)}
+    finally:
+        adm.close()
+
+
+def bench_rpc_retry(mode, n, latency, cache):
+    z = loader.load()
+    adm = MockADM(latency=latency)
+    runs = [0]
+
+    def sweep():
+        time.sleep(0.02)
+        runs[0] += 1
+        return runs[0]
+
+    try:
+        uid, d = _device(z, adm, rpc={"sweep": sweep}, rpc_cache=8 if cache else 0, **MODES[mode])
+        rtts = []
+        for i in range(n):
+            c = adm.call(uid, "sweep")
+            if not c["done"].wait(10):
+                return {"error": "call %d lost" % i}
+            c = adm.call(uid, "sweep", cid=c["id"])
+            if not c["done"].wait(10) or c["reply"] is None:
+                return {"error": "retry %d lost" % i}
+            rtts.append((c["t1"] - c["t0"]) * 1000)
+        return {"retry_p50_ms": round(statistics.median(rtts), 2), "runs": runs[0], "calls": 2 * n}
+    finally:
+        adm.close()
+
+
+def bench_reconnect(mode, n, latency):
+    z = loader.load()
+    adm = MockADM(latency=latency)
+    try:
+        uid, d = _device(z, adm, backoff_min=100, backoff_max=1000, **MODES[mode])
+        times = []
+        for i in range(n):
+            logins = adm.logins
+            t0 = time.monotonic()
+            adm.kill(uid)
+            while adm.logins == logins:
+                if time.monotonic() - t0 > 30:
+                    return {"error": "no login"}
+                time.sleep(0.001)
+            times.append((time.monotonic() - t0) * 1000)
+        return {"mean_ms": round(statistics.mean(times), 1), "max_ms": round(max(times), 1),
+                "reconnects": d.stats.reconnects}
+    finally:
+        adm.close()
+
+
+def bench_halfopen(mode, n, latency):
+    z = loader.load()
+    adm = MockADM(latency=latency)
+    try:
+        uid, d = _device(z, adm, backoff_min=100, backoff_max=1000, ping=1000, read_timeout=1000, **MODES[mode])
+        times = []
+        for i in range(n):
+            logins = adm.logins
+            t0 = time.monotonic()
+            adm.freeze(uid)
+            while adm.logins == logins:
+                if time.monotonic() - t0 > 30:
+                    return {"error": "no login"}
+                time.sleep(0.001)
+            times.append((time.monotonic() - t0) * 1000)
+        return {"mean_ms": round(statistics.mean(times), 1), "max_ms": round(max(times), 1),
+                "timeouts": d.stats.timeouts}
+    finally:
+        adm.close()
+
+
+def bench_failover(mode, n, latency):
+    z = loader.load()
+    resolver = getattr(z.__dict__["__builtins__"], "__default_net")["sock"][0]
+    resolver.hosts.update({"adm-a.bench": "127.0.0.1", "adm-b.bench": "127.0.0.1"})
+    resolver.delay_ms = 50
+    a = MockADM(latency=latency)
+    b = MockADM(latency=latency)
+    try:
+        uid = _new_uid()
+        d = z.Device(uid, "tok", endpoints=[("adm-a.bench", a.port), ("adm-b.bench", b.port)],
+                     backoff_min=100, backoff_max=1000, **MODES[mode])
+        d.start()
+        if a.wait_login(uid) is None:
+            return {"error": "no login"}
+        # reconnections to the same node
+        for i in range(n):
+            logins = a.logins
+            a.kill(uid)
+            while a.logins == logins:
+                time.sleep(0.001)
+        t0 = time.monotonic()
+        a.close()
+        if b.wait_login(uid, 30) is None:
+            return {"error": "no failover"}
+        return {"failover_ms": round((time.monotonic() - t0) * 1000, 1), "lookups": d.endpoints.lookups}
+    finally:
+        resolver.delay_ms = 0
+        a.close()
+        b.close()
+
+
+def _ram_device(port, uid, kw, out):
+    import tracemalloc
+    z = loader.load()
+    _gc.collect()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    d = z.Device(uid, "tok", ip="127.0.0.1", port=port, **kw)
+    d.start()
+    while not d.logged:
+        time.sleep(0.01)
+    # let every loop of the mode go round a few times before measuring what stays allocated
+    time.sleep(0.3)
+    _gc.collect()
+    heap, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    out.put({"heap": heap - base, "peak": peak - base, "threads": zbuiltins.started})
+
+
+def _ram(kw, stack, latency):
+    adm = MockADM(latency=latency)
+    ctx = multiprocessing.get_context("spawn")
+    out = ctx.Queue()
+    p = ctx.Process(target=_ram_device, args=(adm.port, _new_uid(), kw, out), daemon=True)
+    p.start()
+    try:
+        r = out.get(timeout=30)
+    finally:
+        p.terminate()
+        adm.close()
+    # thread() is called without a size: each thread takes the default stack of the VM
+    stacks = r["threads"] * stack
+    return {
+        "peak_kb": round((stacks + r["peak"]) / 1024, 1),
+        "stack_kb": round(stacks / 1024, 1),
+        "heap_kb": round(r["heap"] / 1024, 1),
+        "threads": r["threads"],
+    }
+
+
+def bench_ram(mode, stack, latency):
+    r = _ram(MODES[mode], stack, latency)
+    w = _ram(dict(MODES[mode], rpc_workers=2), stack, latency)
+    r["with_2_workers_peak_kb"] = w["peak_kb"]
+    r["with_2_workers_threads"] = w["threads"]
+    return r
+
+
+def run(quick=False, latency=0, stack=STACK):
+    size = 64 * 1024 if quick else 512 * 1024
+    n_events = 500 if quick else 5000
+    n_calls = 50 if quick else 500
+    n_kills = 3 if quick else 10
+    results = []
+
+    def record(name, mode, variant, r):
+        results.append({"bench": name, "mode": mode, "variant": variant, "result": r})
+        print("%-10s %-8s %-8s %s" % (name, mode, variant, " ".join("%s=%s" % kv for kv in r.items())))
+        sys.stdout.flush()
+
+    for mode in MODES:
+        for transport in TRANSPORTS:
+            record("ota", mode, transport, bench_ota(mode, transport, size, latency))
+    for mode in MODES:
+        for delta in (False, True):
+            record("ota_delta", mode, "delta" if delta else "full", bench_ota_delta(mode, delta, size, latency))
+    for mode in MODES:
+        for lz in (False, True):
+            record("ota_lz", mode, "lz" if lz else "raw", bench_ota_lz(mode, lz, size, latency))
+    for mode in MODES:
+        for transport in TRANSPORTS:
+            record("ota_heap", mode, transport, bench_ota_heap(mode, transport, size, latency))
+    for mode in MODES:
+        record("events", mode, "evnt", bench_events(mode, n_events, latency))
+        record("events", mode, "evnt-cbor", bench_events(mode, n_events, latency, compact=True))
+        record("events", mode, "batcher", bench_events(mode, n_events, latency, batch=True))
+    for mode in MODES:
+        for limited in (False, True):
+            record("limits", mode, "limit" if limited else "-", bench_limits(mode, 1 if quick else 5, latency, limited))
+    for mode in MODES:
+        record("rpc", mode, "-", bench_rpc(mode, n_calls, latency))
+    for mode in MODES:
+        for cache in (False, True):
+            record("rpc_retry", mode, "cache" if cache else "-", bench_rpc_retry(mode, n_calls // 5, latency, cache))
+    for mode in MODES:
+        record("reconnect", mode, "-", bench_reconnect(mode, n_kills, latency))
+    for mode in MODES:
+        record("failover", mode, "-", bench_failover(mode, n_kills, latency))
+    for mode in MODES:
+        record("halfopen", mode, "-", bench_halfopen(mode, n_kills, latency))
+    for mode in MODES:
+        record("ram", mode, "-", bench_ram(mode, stack, latency))
+    return results
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--quick", action="store_true", help="smaller images and fewer iterations")
+    ap.add_argument("--latency", type=float, default=0, help="one-way latency in ms")
+    ap.add_argument("--stack", type=int, default=STACK, help="thread stack size in bytes")
+    ap.add_argument("--json", metavar="PATH", help="also write the results to PATH")
+    args = ap.parse_args(argv)
+    results = run(args.quick, args.latency, args.stack)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Independent CPython codec for the compact encoding offered by ``zadm.Device``.
+
+Standard CBOR for integers, strings, byte strings, arrays, maps and simple
+values; floats are written as decimal fractions (tag 4), the only float form
+the device decodes. Float16/32/64 items are accepted when decoding.
+"""
+
+import struct
+from decimal import Decimal
+
+
+def _head(out, major, n):
+    if n < 24:
+        out.append(major << 5 | n)
+    elif n < 1 << 8:
+        out += bytes((major << 5 | 24, n))
+    elif n < 1 << 16:
+        out.append(major << 5 | 25)
+        out += n.to_bytes(2, "big")
+    elif n < 1 << 32:
+        out.append(major << 5 | 26)
+        out += n.to_bytes(4, "big")
+    else:
+        out.append(major << 5 | 27)
+        out += n.to_bytes(8, "big")
+
+
+def encode(obj, out=None):
+    if out is None:
+        out = bytearray()
+    if obj is None:
+        out.append(0xf6)
+    elif obj is True:
+        out.append(0xf5)
+    elif obj is False:
+        out.append(0xf4)
+    elif isinstance(obj, int):
+        if obj < 0:
+            _head(out, 1, -1 - obj)
+        else:
+            _head(out, 0, obj)
+    elif isinstance(obj, float):
+        sign, digits, exp = Decimal(repr(obj)).as_tuple()
+        m = int("".join(map(str, digits)) or "0")
+        out.append(0xc4)
+        out.append(0x82)
+        encode(exp, out)
+        encode(-m if sign else m, out)
+    elif isinstance(obj, str):
+        bb = obj.encode()
+        _head(out, 3, len(bb))
+        out += bb
+    elif isinstance(obj, (bytes, bytearray)):
+        _head(out, 2, len(obj))
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        _head(out, 4, len(obj))
+        for x in obj:
+            encode(x, out)
+    elif isinstance(obj, dict):
+        _head(out, 5, len(obj))
+        for k, v in obj.items():
+            encode(k, out)
+            encode(v, out)
+    else:
+        raise TypeError(type(obj))
+    return out
+
+
+def frame(msg):
+    body = encode(msg)
+    return bytes((3, len(body) >> 8, len(body) & 0xff)) + bytes(body)
+
+
+def decode(buf, i=0):
+    ib = buf[i]
+    major, n = ib >> 5, ib & 31
+    i += 1
+    if major == 7:
+        if n in (20, 21, 22):
+            return (False, True, None)[n - 20], i
+        fmt = {25: ">e", 26: ">f", 27: ">d"}[n]
+        k = struct.calcsize(fmt)
+        return struct.unpack(fmt, bytes(buf[i:i + k]))[0], i + k
+    if n >= 24:
+        k = 1 << (n - 24)
+        n = int.from_bytes(buf[i:i + k], "big")
+        i += k
+    if major == 0:
+        return n, i
+    if major == 1:
+        return -1 - n, i
+    if major == 2:
+        return bytes(buf[i:i + n]), i + n
+    if major == 3:
+        return bytes(buf[i:i + n]).decode(), i + n
+    if major == 4:
+        out = []
+        for _ in range(n):
+            x, i = decode(buf, i)
+            out.append(x)
+        return out, i
+    if major == 5:
+        out = {}
+        for _ in range(n):
+            k, i = decode(buf, i)
+            out[k], i = decode(buf, i)
+        return out, i
+    if major == 6 and n == 4:
+        (e, m), i = decode(buf, i)
+        return float(Decimal(m).scaleb(e)), i
+    raise ValueError("unsupported item %02x" % ib)
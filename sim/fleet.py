@@ -0,0 +1,340 @@
+"""Fleet load generator: many ``zadm.Device`` instances against one mock ADM.
+
+Run from the repository root::
+
+    python -m sim.fleet --devices 1000 --procs 2 --duration 20 \\
+        --login-rate 200 --event-ms 1000 --rpc-rate 100 --storm-at 8 --ota 20
+
+The mock ADM runs in this process; devices are split among ``--procs`` child
+processes. A threaded ``Device`` needs up to three OS threads, so devices are
+not started: each process drives all of its devices, in single thread mode,
+from one thread with a ``selectors`` loop calling ``Device._step_tx`` and
+``Device._step_rx``. Logins (``Device._connect``, with the client's own
+backoff) run in a pool of threads, since they block.
+
+Scenarios, all optional and combined in one run:
+
+* staggered logins at ``--login-rate`` devices per second (0: all at once)
+* mixed traffic: one event every ``--event-ms`` from each device and
+  ``--rpc-rate`` RPC calls per second from the ADM to random devices
+* a synchronized reconnect storm ``--storm-at`` seconds into the run: the
+  ADM drops every connection at once
+* a concurrent FOTA rollout of ``--ota-kb`` images to ``--ota`` devices, which
+  reboot on the new image and log in again
+
+The report has the aggregate throughput and the tail latencies seen by the ADM.
+"""
+
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import queue
+import random
+import selectors
+import threading
+import time
+
+from . import loader
+from .adm import MockADM
+from .stubs import fota, mcu
+from .stubs.zbuiltins import QueueFull
+
+
+class _Sim():
+    """A simulated device: its Device instance, flash and scheduling state."""
+
+    def __init__(self, uid, flash):
+        self.uid = uid
+        self.flash = flash
+        self.d = None
+        self.online = False
+
+
+class Fleet():
+    """Drives *uids* devices from one thread (see the module docstring)."""
+
+    def __init__(self, z, port, uids, event_ms=0, flash_kb=64, connectors=64, **devkw):
+        self.z = z
+        self.port = port
+        self.event_ms = event_ms
+        self.devkw = devkw
+        self.sims = [_Sim(uid, fota.Flash(slot_size=flash_kb * 1024)) for uid in uids]
+        self.connectq = queue.Queue()
+        self.joined = queue.Queue()
+        self.sel = selectors.DefaultSelector()
+        self.dirty = set()
+        self.counters = {"events": 0, "event_drops": 0, "logins": 0, "failures": 0, "reboots": 0}
+        self.connect_ms = []
+        # the device sleeps a second before resetting at the end of an update:
+        # that must not stall the other devices driven by the same thread
+        bt = z.__dict__["__builtins__"]
+        sleep = bt.sleep
+        self._driver = None
+
+        def _sleep(ms):
+            if threading.current_thread() is not self._driver:
+                sleep(ms)
+
+        bt.sleep = _sleep
+        for i in range(min(connectors, len(self.sims))):
+            threading.Thread(target=self._connector, daemon=True).start()
+
+    def _new_device(self, s):
+        s.d = self.z.Device(s.uid, "tok", ip="127.0.0.1", port=self.port, single_thread=True,
+                            rpc={"echo": lambda x: x}, **self.devkw)
+
+    def _connector(self):
+        while True:
+            s = self.connectq.get()
+            fota.select(s.flash)
+            t0 = time.monotonic()
+            s.d._connect()
+            self.connect_ms.append((time.monotonic() - t0) * 1000)
+            self.joined.put(s)
+
+    def login(self, s):
+        if s.d is None:
+            self._new_device(s)
+        self.connectq.put(s)
+
+    def _join(self, s):
+        s.online = True
+        self.counters["logins"] += 1
+        try:
+            self.sel.register(s.d._sock, selectors.EVENT_READ, s)
+        except (ValueError, OSError):
+            # dropped by the ADM in the meantime
+            self._drop(s)
+            return
+        self.dirty.add(s)
+        # the login read may have buffered what the ADM sent right after it
+        if self._buffered(s):
+            self._read(s)
+
+    def _drop(self, s, reboot=False):
+        s.online = False
+        try:
+            self.sel.unregister(s.d._sock)
+        except (KeyError, ValueError):
+            pass
+        if reboot:
+            # a new Device on the new image, as after a real reset
+            s.d._closeall()
+            fota.reboot()
+            self.counters["reboots"] += 1
+            self._new_device(s)
+        else:
+            self.counters["failures"] += 1
+            s.d._reconnect()
+        self.connectq.put(s)
+
+    def _run(self, s, fn, arg):
+        fota.select(s.flash)
+        try:
+            fn(arg)
+            return True
+        except mcu.Reset:
+            self._drop(s, reboot=True)
+        except Exception:
+            self._drop(s)
+        return False
+
+    def _buffered(self, s):
+        st = s.d._client
+        return st._start < st._end
+
+    def _read(self, s):
+        for i in range(16):
+            if not s.online or not self._run(s, s.d._step_rx, 1):
+                return
+            self.dirty.add(s)
+            if not self._buffered(s):
+                return
+
+    def run(self, stop, login_rate=0):
+        """Run until the multiprocessing event *stop* is set."""
+        self._driver = threading.current_thread()
+        pending = list(self.sims)
+        t_start = time.monotonic()
+        events = []
+        if self.event_ms:
+            for i, s in enumerate(self.sims):
+                heapq.heappush(events, (t_start + random.uniform(0, self.event_ms / 1000), i))
+        sweep = t_start
+        n = 0
+        while not stop.is_set():
+            now = time.monotonic()
+            # staggered logins
+            if pending:
+                due = len(pending) if not login_rate else int((now - t_start) * login_rate) - (len(self.sims) - len(pending))
+                for s in pending[:max(due, 0)]:
+                    self.login(s)
+                del pending[:max(due, 0)]
+            while True:
+                try:
+                    self._join(self.joined.get_nowait())
+                except queue.Empty:
+                    break
+            # events
+            while events and events[0][0] <= now:
+                t, i = heapq.heappop(events)
+                heapq.heappush(events, (t + self.event_ms / 1000, i))
+                s = self.sims[i]
+                if s.online:
+                    n += 1
+                    try:
+                        s.d.send_event({"n": n})
+                        self.counters["events"] += 1
+                        self.dirty.add(s)
+                    except QueueFull:
+                        self.counters["event_drops"] += 1
+            # heartbeats and stored events are checked once a second
+            if now - sweep >= 1:
+                sweep = now
+                self.dirty.update(s for s in self.sims if s.online)
+            dirty, self.dirty = self.dirty, set()
+            for s in dirty:
+                if s.online:
+                    self._run(s, s.d._step_tx, 0)
+            timeout = 0.01
+            if events:
+                timeout = max(0, min(timeout, events[0][0] - time.monotonic()))
+            for key, _ in self.sel.select(timeout):
+                self._read(key.data)
+
+    def report(self):
+        rec = sum(s.d.stats.reconnects for s in self.sims if s.d is not None)
+        return dict(self.counters, reconnects=rec, threads=threading.active_count(),
+                    connect_ms=sorted(self.connect_ms))
+
+
+def _shard(port, uids, opts, stop, out):
+    z = loader.load()
+    fl = Fleet(z, port, uids, event_ms=opts["event_ms"], flash_kb=opts["flash_kb"],
+               backoff_min=opts["backoff_min"], backoff_max=opts["backoff_max"])
+    fl.run(stop, opts["login_rate"])
+    out.put(fl.report())
+
+
+def _pct(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))], 2)
+
+
+def _wait_sessions(adm, n, timeout):
+    t0 = time.monotonic()
+    while len(adm.sessions) < n:
+        if time.monotonic() - t0 > timeout:
+            return None
+        time.sleep(0.01)
+    return round(time.monotonic() - t0, 3)
+
+
+def run(devices=100, procs=1, duration=10, login_rate=0, event_ms=1000, rpc_rate=10, storm_at=None,
+        ota=0, ota_kb=16, flash_kb=64, backoff_min=1000, backoff_max=60000):
+    adm = MockADM(record_events=False, frames=True, ota_window=4, icrc=True)
+    uids = ["fleet%05d" % i for i in range(devices)]
+    opts = {"event_ms": event_ms, "flash_kb": flash_kb, "login_rate": login_rate / procs,
+            "backoff_min": backoff_min, "backoff_max": backoff_max}
+    ctx = multiprocessing.get_context("spawn")
+    stop = ctx.Event()
+    out = ctx.Queue()
+    workers = [ctx.Process(target=_shard, args=(adm.port, uids[i::procs], opts, stop, out), daemon=True)
+               for i in range(procs)]
+    t0 = time.monotonic()
+    for p in workers:
+        p.start()
+    report = {"devices": devices, "procs": procs}
+    report["all_logged_s"] = _wait_sessions(adm, devices, duration)
+    calls = []
+    jobs = []
+    storm = None
+    ota_t0 = None
+    end = t0 + duration
+    next_call = time.monotonic()
+    while time.monotonic() < end:
+        now = time.monotonic()
+        if storm_at is not None and storm is None and now - t0 >= storm_at:
+            adm.kill()
+            storm = now
+            report["storm_recovery_s"] = None
+        if storm is not None and report.get("storm_recovery_s") is None and len(adm.sessions) >= devices:
+            report["storm_recovery_s"] = round(now - storm, 3)
+        if ota and ota_t0 is None and report["all_logged_s"] is not None and (storm is None or report.get("storm_recovery_s")):
+            ota_t0 = now
+            image = os.urandom(ota_kb * 1024)
+            for uid in random.sample(uids, ota):
+                if uid in adm.sessions:
+                    jobs.append(adm.ota(uid, image, b"", chunk=512))
+        if rpc_rate and now >= next_call:
+            connected = list(adm.sessions)
+            if connected:
+                calls.append(adm.call(random.choice(connected), "echo", (1,)))
+            next_call += 1 / rpc_rate
+        time.sleep(max(0, min(0.005, next_call - time.monotonic())) if rpc_rate else 0.01)
+    elapsed = time.monotonic() - t0
+    stop.set()
+    shards = [out.get(timeout=60) for p in workers]
+    rtt = [(c["t1"] - c["t0"]) * 1000 for c in calls if c["t1"] is not None]
+    connect_ms = sorted(x for sh in shards for x in sh["connect_ms"])
+    report.update({
+        "events_s": round(adm.counters.get("events", 0) / elapsed, 1),
+        "event_drops": sum(sh["event_drops"] for sh in shards),
+        "rx_mb_s": round(adm.counters.get("rx_bytes", 0) / elapsed / 1e6, 3),
+        "tx_mb_s": round(adm.counters.get("tx_bytes", 0) / elapsed / 1e6, 3),
+        "rpc_calls": len(calls),
+        "rpc_answered": len(rtt),
+        "rpc_p50_ms": _pct(rtt, 50),
+        "rpc_p99_ms": _pct(rtt, 99),
+        "rpc_p999_ms": _pct(rtt, 99.9),
+        "connect_p50_ms": _pct(connect_ms, 50),
+        "connect_p99_ms": _pct(connect_ms, 99),
+        "adm_logins": adm.logins,
+        "link_failures": sum(sh["failures"] for sh in shards),
+        "threads_per_proc": [sh["threads"] for sh in shards],
+    })
+    if jobs:
+        done = [j for j in jobs if j.ok]
+        report["ota_started"] = len(jobs)
+        report["ota_done"] = len(done)
+        report["ota_reboots"] = sum(sh["reboots"] for sh in shards)
+        if done:
+            report["ota_p50_s"] = _pct([j.t1 - j.t0 for j in done], 50)
+            report["ota_max_s"] = round(max(j.t1 for j in done) - ota_t0, 3)
+    for p in workers:
+        p.join(5)
+    adm.close()
+    return report
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    ap.add_argument("--devices", type=int, default=100)
+    ap.add_argument("--procs", type=int, default=1, help="host processes running the devices")
+    ap.add_argument("--duration", type=float, default=10, help="seconds")
+    ap.add_argument("--login-rate", type=float, default=0, help="logins per second, 0 for all at once")
+    ap.add_argument("--event-ms", type=int, default=1000, help="ms between events of a device, 0 for none")
+    ap.add_argument("--rpc-rate", type=float, default=10, help="RPC calls per second")
+    ap.add_argument("--storm-at", type=float, help="drop every connection after these seconds")
+    ap.add_argument("--ota", type=int, default=0, help="devices receiving a FOTA update")
+    ap.add_argument("--ota-kb", type=int, default=16, help="FOTA image size")
+    ap.add_argument("--flash-kb", type=int, default=64, help="size of each simulated flash slot")
+    ap.add_argument("--backoff-min", type=int, default=1000)
+    ap.add_argument("--backoff-max", type=int, default=60000)
+    ap.add_argument("--json", metavar="PATH", help="also write the report to PATH")
+    args = ap.parse_args(argv)
+    report = run(args.devices, args.procs, args.duration, args.login_rate, args.event_ms, args.rpc_rate,
+                 args.storm_at, args.ota, args.ota_kb, args.flash_kb, args.backoff_min, args.backoff_max)
+    for k, v in report.items():
+        print("%-18s %s" % (k, v))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
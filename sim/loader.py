@@ -0,0 +1,68 @@
+"""Load ``zadm.py`` under CPython.
+
+The Zerynth compiler resolves ``__define`` constants at compile time and ships
+its own ``socket``, ``streams``, ``queue``, ``threading``, ``timers``, ``vm``,
+``fota``, ``mcu`` and ``gc`` modules.  :func:`load` mimics both: constants are
+substituted in the source before compiling, and imports of those modules are
+redirected to the stand-ins in :mod:`sim.stubs` without touching
+``sys.modules``, so the real modules stay available to the rest of the host
+process (mock ADM, benchmarks).
+"""
+
+import builtins
+import os
+import re
+import types
+
+from .stubs import zbuiltins
+from .stubs import fota, gc, mcu, queue, socket, streams, threading, timers, vm
+
+ZADM_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "zadm.py")
+
+STUBS = {
+    "fota": fota,
+    "gc": gc,
+    "mcu": mcu,
+    "queue": queue,
+    "socket": socket,
+    "streams": streams,
+    "threading": threading,
+    "timers": timers,
+    "vm": vm,
+}
+
+_define = re.compile(r"^__define\((\w+)\s*,\s*(.+)\)\s*$", re.M)
+
+
+def _builtins():
+    bt = types.ModuleType("builtins")
+    bt.__dict__.update(builtins.__dict__)
+    for name in dir(zbuiltins):
+        if not name.startswith("_") or name == "__default_net":
+            setattr(bt, name, getattr(zbuiltins, name))
+    setattr(bt, "__default_net", zbuiltins.__dict__["__default_net"])
+
+    def _import(name, globals=None, locals=None, fromlist=(), level=0):
+        if level == 0 and name in STUBS:
+            return STUBS[name]
+        return builtins.__import__(name, globals, locals, fromlist, level)
+
+    bt.__import__ = _import
+    return bt
+
+
+def load(path=ZADM_PATH, name="zadm"):
+    """Compile and execute *path*, returning it as a fresh module object."""
+    with open(path) as f:
+        src = f.read()
+    consts = dict(_define.findall(src))
+    src = _define.sub("", src)
+    if consts:
+        src = re.sub(r"\b(" + "|".join(map(re.escape, consts)) + r")\b", lambda m: consts[m.group(1)], src)
+    # CPython mangles __names used inside classes, the Zerynth compiler does not
+    src = src.replace("__builtins__.__default_net", 'getattr(__builtins__, "__default_net")')
+    mod = types.ModuleType(name)
+    mod.__file__ = path
+    mod.__dict__["__builtins__"] = _builtins()
+    exec(compile(src, path, "exec"), mod.__dict__)
+    return mod
@@ -0,0 +1,104 @@
+"""Host LZSS codec in the heatshrink format, for compressed FOTA images.
+
+A set bit is followed by a literal byte; a clear bit by ``offset - 1`` in
+``w`` bits and ``length - 1`` in ``l`` bits of a match within the last
+``2**w`` bytes. Bits are packed msb first and the last byte is padded with
+zeros. The window starts zeroed, as in heatshrink; the encoder here never
+refers to it before the first byte.
+"""
+
+# candidate positions tried for each match
+_CHAIN = 32
+
+
+class _Bits():
+
+    def __init__(self):
+        self.out = bytearray()
+        self.acc = 0
+        self.n = 0
+
+    def put(self, v, k):
+        self.acc = (self.acc << k) | v
+        self.n += k
+        while self.n >= 8:
+            self.n -= 8
+            self.out.append((self.acc >> self.n) & 0xff)
+        self.acc &= (1 << self.n) - 1
+
+    def bytes(self):
+        if self.n:
+            self.out.append((self.acc << (8 - self.n)) & 0xff)
+        return bytes(self.out)
+
+
+def compress(data, w=8, l=4):
+    """Greedy LZSS with a hash chain over ``minlen`` byte prefixes."""
+    window = 1 << w
+    maxlen = 1 << l
+    # shortest match cheaper than its literals
+    minlen = (1 + w + l) // 9 + 1
+    bits = _Bits()
+    heads = {}
+    n = len(data)
+    i = 0
+    while i < n:
+        best = 0
+        off = 0
+        if i + minlen <= n:
+            for p in reversed(heads.get(data[i:i + minlen], ())[-_CHAIN:]):
+                if i - p > window:
+                    break
+                k = minlen
+                while k < maxlen and i + k < n and data[p + k] == data[i + k]:
+                    k += 1
+                if k > best:
+                    best = k
+                    off = i - p
+                    if k == maxlen:
+                        break
+        step = best if best >= minlen else 1
+        if step > 1:
+            bits.put(0, 1)
+            bits.put(off - 1, w)
+            bits.put(best - 1, l)
+        else:
+            bits.put(1, 1)
+            bits.put(data[i], 8)
+        for j in range(i, min(i + step, n - minlen + 1)):
+            chain = heads.setdefault(data[j:j + minlen], [])
+            chain.append(j)
+            if len(chain) > 2 * _CHAIN:
+                del chain[:_CHAIN]
+        i += step
+    return bits.bytes()
+
+
+def decompress(data, w=8, l=4, size=None):
+    """Reference decoder; stops at *size* bytes when given (the padding is not a symbol)."""
+    out = bytearray()
+    acc = 0
+    nacc = 0
+    it = iter(data)
+
+    def get(k):
+        nonlocal acc, nacc
+        while nacc < k:
+            acc = (acc << 8) | next(it)
+            nacc += 8
+        nacc -= k
+        v = acc >> nacc
+        acc &= (1 << nacc) - 1
+        return v
+
+    try:
+        while size is None or len(out) < size:
+            if get(1):
+                out.append(get(8))
+            else:
+                off = get(w) + 1
+                for i in range(get(l) + 1):
+                    out.append(out[-off] if off <= len(out) else 0)
+    except StopIteration:
+        pass
+    return bytes(out[:size]) if size is not None else bytes(out)
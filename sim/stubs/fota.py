@@ -0,0 +1,172 @@
+"""CPython stand-in for the Zerynth ``fota`` module.
+
+Flash is modelled as two VM slots followed by two bytecode slots, kept in RAM
+or in a file.  Erases work on whole sectors like real NOR flash and writes can
+only clear bits, so a block written into a non-erased area is detected and
+counted in :data:`flash.bad_writes`.
+"""
+
+import hashlib as _hashlib
+import threading as _threading
+import time as _time
+
+SECTOR = 4096
+SLOT_SIZE = 256 * 1024
+CHUNK = 512
+
+
+class Flash():
+
+    def __init__(self, path=None, sector=SECTOR, slot_size=SLOT_SIZE, chunk=CHUNK, erase_ms=0):
+        self.sector = sector
+        self.slot_size = slot_size
+        self.chunk = chunk
+        self.erase_ms = erase_ms
+        self.size = 4 * slot_size
+        self._blank = b"\xff" * sector
+        self.path = path
+        self._file = None
+        if path:
+            try:
+                self._file = open(path, "r+b")
+            except OSError:
+                self._file = open(path, "w+b")
+            self._file.seek(0, 2)
+            if self._file.tell() < self.size:
+                self._file.write(b"\xff" * (self.size - self._file.tell()))
+            self._file.seek(0)
+            self.mem = bytearray(self._file.read(self.size))
+        else:
+            self.mem = bytearray(b"\xff" * self.size)
+        # (valid, vm slot, vm address, vm size, bc slot, bc address, bc size, sector, chunk)
+        self.vm_slot = 0
+        self.bc_slot = 0
+        self.valid = True
+        self.pending = None
+        self.accepted = 0
+        self.erase_calls = 0
+        self.erased_bytes = 0
+        self.write_calls = 0
+        self.written_bytes = 0
+        self.bad_writes = 0
+
+    def vm_addr(self, slot):
+        return slot * self.slot_size
+
+    def bc_addr(self, slot):
+        return (2 + slot) * self.slot_size
+
+    def record(self):
+        return (self.valid, self.vm_slot, self.vm_addr(self.vm_slot), self.slot_size,
+                self.bc_slot, self.bc_addr(self.bc_slot), self.slot_size, self.sector, self.chunk)
+
+    def _sync(self, start, end):
+        if self._file:
+            self._file.seek(start)
+            self._file.write(self.mem[start:end])
+            self._file.flush()
+
+    def erase(self, addr, size):
+        start = addr - addr % self.sector
+        end = addr + size
+        if end % self.sector:
+            end += self.sector - end % self.sector
+        # sector by sector from a shared blank sector, not to show up in heap measurements
+        for a in range(start, end, self.sector):
+            self.mem[a:a + self.sector] = self._blank
+        self.erase_calls += 1
+        self.erased_bytes += end - start
+        if self.erase_ms:
+            _time.sleep(self.erase_ms * (end - start) // self.sector / 1000)
+        self._sync(start, end)
+
+    def write(self, addr, data):
+        n = len(data)
+        area = self.mem[addr:addr + n]
+        if area.count(0xff) != n:
+            self.bad_writes += 1
+        for i in range(n):
+            area[i] &= data[i]
+        self.mem[addr:addr + n] = area
+        self.write_calls += 1
+        self.written_bytes += n
+        self._sync(addr, addr + n)
+        return n
+
+    def load(self, addr, image):
+        """Place *image* at *addr* as if it had been flashed by a programmer."""
+        self.erase(addr, len(image))
+        self.mem[addr:addr + len(image)] = image
+        self._sync(addr, addr + len(image))
+
+
+flash = Flash()
+_local = _threading.local()
+
+
+def configure(**kwargs):
+    """Replace the flash model; keyword arguments are passed to :class:`Flash`."""
+    global flash
+    flash = Flash(**kwargs)
+    return flash
+
+
+def select(f):
+    """Make the calling thread use the flash *f* (None: the shared one), for many devices in a process."""
+    _local.flash = f
+
+
+def _flash():
+    return getattr(_local, "flash", None) or flash
+
+
+def get_record():
+    return _flash().record()
+
+
+def find_bytecode_slot():
+    f = _flash()
+    return f.bc_addr(1 - f.bc_slot)
+
+
+def find_vm_slot():
+    f = _flash()
+    return f.vm_addr(1 - f.vm_slot)
+
+
+def erase_slot(addr, size):
+    _flash().erase(addr, size)
+
+
+def write_slot(addr, data):
+    return _flash().write(addr, data)
+
+
+def read_slot(addr, buf):
+    n = len(buf)
+    buf[0:n] = _flash().mem[addr:addr + n]
+    return n
+
+
+def checksum_slot(addr, size):
+    return _hashlib.md5(memoryview(_flash().mem)[addr:addr + size]).digest()
+
+
+def close_slot(addr):
+    pass
+
+
+def attempt(bcslot, vmslot):
+    _flash().pending = (bcslot, vmslot)
+
+
+def accept():
+    _flash().accepted += 1
+
+
+def reboot():
+    """Emulate the bootloader: switch to the slots passed to :func:`attempt`."""
+    f = _flash()
+    if f.pending is not None:
+        f.bc_slot, f.vm_slot = f.pending
+        f.pending = None
@@ -0,0 +1,11 @@
+"""CPython stand-in for the Zerynth ``gc`` module."""
+
+import gc as _gc
+
+
+def collect():
+    _gc.collect()
+
+
+def info():
+    return (0, 0, 0, 0, 0)
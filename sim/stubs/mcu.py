@@ -0,0 +1,13 @@
+"""CPython stand-in for the Zerynth ``mcu`` module."""
+
+resets = 0
+
+
+class Reset(BaseException):
+    """Raised by :func:`reset` to unwind the calling thread like a real reboot would."""
+
+
+def reset():
+    global resets
+    resets += 1
+    raise Reset
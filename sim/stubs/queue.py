@@ -0,0 +1,36 @@
+"""CPython stand-in for the Zerynth ``queue`` module.
+
+Timeouts are in milliseconds and failures raise the Zerynth ``QueueEmpty`` and
+``QueueFull`` builtins.
+"""
+
+import queue as _queue
+
+from .zbuiltins import QueueEmpty, QueueFull
+
+
+class Queue():
+
+    def __init__(self, maxsize=0):
+        self._q = _queue.Queue(maxsize)
+
+    def put(self, item, block=True, timeout=-1):
+        try:
+            self._q.put(item, block, None if timeout is None or timeout < 0 else timeout / 1000)
+        except _queue.Full:
+            raise QueueFull
+
+    def get(self, block=True, timeout=-1):
+        try:
+            return self._q.get(block, None if timeout is None or timeout < 0 else timeout / 1000)
+        except _queue.Empty:
+            raise QueueEmpty
+
+    def qsize(self):
+        return self._q.qsize()
+
+    def empty(self):
+        return self._q.empty()
+
+    def full(self):
+        return self._q.full()
@@ -0,0 +1,50 @@
+"""CPython stand-in for the Zerynth ``socket`` module (timeouts in milliseconds)."""
+
+import socket as _socket
+
+SOL_SOCKET = _socket.SOL_SOCKET
+SO_KEEPALIVE = _socket.SO_KEEPALIVE
+IPPROTO_TCP = _socket.IPPROTO_TCP
+TCP_KEEPIDLE = getattr(_socket, "TCP_KEEPIDLE", 4)
+TCP_KEEPINTVL = getattr(_socket, "TCP_KEEPINTVL", 5)
+TCP_KEEPCNT = getattr(_socket, "TCP_KEEPCNT", 6)
+
+
+class socket():
+
+    def __init__(self, family=_socket.AF_INET, type=_socket.SOCK_STREAM, proto=0):
+        self._s = _socket.socket(family, type, proto)
+
+    def connect(self, addr):
+        self._s.connect(addr)
+
+    def settimeout(self, timeout):
+        self._s.settimeout(None if timeout is None or timeout < 0 else timeout / 1000)
+
+    def setsockopt(self, level, optname, value):
+        if level == IPPROTO_TCP and optname == TCP_KEEPIDLE:
+            # Zerynth drivers take milliseconds, the host stack takes seconds
+            value = max(1, value // 1000)
+        self._s.setsockopt(level, optname, value)
+
+    def send(self, data, flags=0):
+        return self._s.send(data, flags)
+
+    def sendall(self, data, flags=0):
+        self._s.sendall(data, flags)
+
+    def recv(self, bufsize, flags=0):
+        return self._s.recv(bufsize, flags)
+
+    def recv_into(self, buf, bufsize, flags=0, ofs=0):
+        return self._s.recv_into(memoryview(buf)[ofs:ofs + bufsize], bufsize, flags)
+
+    def fileno(self):
+        return self._s.fileno()
+
+    def close(self):
+        try:
+            self._s.shutdown(_socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._s.close()
@@ -0,0 +1,65 @@
+"""CPython stand-in for the Zerynth ``streams`` module.
+
+Incoming data goes through a fixed receive buffer filled with ``recv_into``, so
+the stream itself does not allocate while reading and heap measurements of
+``zadm.py`` are not polluted.
+"""
+
+
+def serial(*args, **kwargs):
+    pass
+
+
+class SocketStream():
+
+    def __init__(self, sock, size=2048):
+        self.sock = sock
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def _fill(self):
+        # only called when the buffer is empty
+        self._start = 0
+        self._end = 0
+        self._end = self.sock.recv_into(self._buf, len(self._buf))
+        return self._end > 0
+
+    def read(self, size=1):
+        if self._start == self._end and not self._fill():
+            return b""
+        n = min(size, self._end - self._start)
+        data = bytes(self._buf[self._start:self._start + n])
+        self._start += n
+        return data
+
+    def readinto(self, buf, size=-1, ofs=0):
+        if size < 0:
+            size = len(buf) - ofs
+        if self._start == self._end and not self._fill():
+            return 0
+        n = min(size, self._end - self._start)
+        buf[ofs:ofs + n] = memoryview(self._buf)[self._start:self._start + n]
+        self._start += n
+        return n
+
+    def readline(self):
+        parts = []
+        while True:
+            if self._start == self._end and not self._fill():
+                return b"".join(parts)
+            i = self._buf.find(b"\n", self._start, self._end)
+            end = self._end if i < 0 else i + 1
+            parts.append(bytes(self._buf[self._start:end]))
+            self._start = end
+            if i >= 0:
+                return b"".join(parts)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.sock.sendall(data)
+        return len(data)
+
+    def close(self):
+        self.sock.close()
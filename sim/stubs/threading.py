@@ -0,0 +1,63 @@
+"""CPython stand-in for the Zerynth ``threading`` module (timeouts in milliseconds)."""
+
+import threading as _threading
+
+
+def _secs(timeout):
+    if timeout is None or timeout < 0:
+        return None
+    return timeout / 1000
+
+
+class Lock():
+
+    def __init__(self):
+        self._l = _threading.Lock()
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not blocking:
+            return self._l.acquire(False)
+        t = _secs(timeout)
+        return self._l.acquire(True, -1 if t is None else t)
+
+    def release(self):
+        self._l.release()
+
+
+class Condition():
+
+    def __init__(self, lock=None):
+        self._c = _threading.Condition(lock._l if lock is not None else None)
+
+    def acquire(self, *args):
+        return self._c.acquire(*args)
+
+    def release(self):
+        self._c.release()
+
+    def wait(self, timeout=-1):
+        return self._c.wait(_secs(timeout))
+
+    def notify(self, n=1):
+        self._c.notify(n)
+
+    def notify_all(self):
+        self._c.notify_all()
+
+
+class Event():
+
+    def __init__(self):
+        self._e = _threading.Event()
+
+    def set(self):
+        self._e.set()
+
+    def clear(self):
+        self._e.clear()
+
+    def is_set(self):
+        return self._e.is_set()
+
+    def wait(self, timeout=-1):
+        return self._e.wait(_secs(timeout))
@@ -0,0 +1,30 @@
+"""CPython stand-in for the Zerynth ``timers`` module (milliseconds everywhere)."""
+
+import threading as _threading
+import time as _time
+
+_t0 = _time.monotonic()
+
+
+def now():
+    return int((_time.monotonic() - _t0) * 1000)
+
+
+class timer():
+
+    def __init__(self):
+        self._tm = None
+
+    def one_shot(self, timeout, fun, arg=None):
+        self.clear()
+        if arg is None:
+            self._tm = _threading.Timer(timeout / 1000, fun)
+        else:
+            self._tm = _threading.Timer(timeout / 1000, fun, (arg,))
+        self._tm.daemon = True
+        self._tm.start()
+
+    def clear(self):
+        if self._tm is not None:
+            self._tm.cancel()
+            self._tm = None
@@ -0,0 +1,8 @@
+"""CPython stand-in for the Zerynth ``vm`` module."""
+
+VMUID = "hostsim0000000000000000"
+PLATFORM = "host-sim"
+
+
+def info():
+    return (VMUID, PLATFORM, "r2.x", "cpython")
@@ -0,0 +1,58 @@
+"""Zerynth builtins that have no CPython counterpart.
+
+The loader merges these names into the builtins seen by ``zadm.py``.
+"""
+
+import random as _random
+import threading as _threading
+import time as _time
+
+
+class QueueEmpty(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+def sleep(ms):
+    _time.sleep(ms / 1000)
+
+
+started = 0  # threads started by the code under simulation
+
+
+def thread(fun, *args):
+    global started
+    started += 1
+    th = _threading.Thread(target=fun, args=args, daemon=True)
+    th.start()
+    return th
+
+
+def random(a=None, b=None):
+    if a is None:
+        return _random.getrandbits(31)
+    return _random.randint(a, b)
+
+
+class _Resolver():
+    """Name resolution of the network driver: names in :attr:`hosts` first, then the host's resolver."""
+
+    def __init__(self):
+        self.hosts = {}
+        self.lookups = 0
+        self.delay_ms = 0
+
+    def gethostbyname(self, name):
+        self.lookups += 1
+        if self.delay_ms:
+            _time.sleep(self.delay_ms / 1000)
+        if name in self.hosts:
+            return self.hosts[name]
+        import socket
+        return socket.gethostbyname(name)
+
+
+__default_net = {"sock": [_Resolver()]}
@@ -0,0 +1,89 @@
+"""Behaviour tests of ``zadm.py`` on the host, through :mod:`sim`.
+
+Run from the repository root::
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sim import loader  # noqa: E402
+from sim.adm import MockADM  # noqa: E402
+from sim.stubs import fota  # noqa: E402
+
+
+@pytest.fixture
+def z():
+    """A fresh copy of ``zadm.py`` with a blank flash."""
+    fota.configure()
+    return loader.load()
+
+
+@pytest.fixture
+def adm_factory():
+    adms = []
+
+    def make(**kw):
+        adm = MockADM(**kw)
+        adms.append(adm)
+        return adm
+
+    yield make
+    for adm in adms:
+        adm.close()
+
+
+_uid = [0]
+
+
+def connect(z, adm, **kw):
+    """Start a Device logged in to *adm*, stopping FOTA updates before the reset."""
+    _uid[0] += 1
+    uid = "test%d" % _uid[0]
+    kw.setdefault("fota_callback", lambda step: step != 1)
+    kw.setdefault("compact", adm.compact)
+    d = z.Device(uid, "tok", ip="127.0.0.1", port=adm.port, **kw)
+    d.start()
+    assert adm.wait_login(uid) is not None
+    return uid, d
+
+
+class Stream():
+    """Incoming bytes of a Device, for decoding frames without a socket."""
+
+    def __init__(self, data):
+        self.data = bytearray(data)
+
+    def read(self, n):
+        r = bytes(self.data[:n])
+        del self.data[:n]
+        return r
+
+    def readinto(self, buf, n, off=0):
+        k = min(n, len(self.data))
+        memoryview(buf)[off:off + k] = self.data[:k]
+        del self.data[:k]
+        return k
+
+
+class _Stats():
+
+    def rx(self, n):
+        pass
+
+
+def reader(z, data, ota_buf=None):
+    """A Device reading *data*, without connecting it."""
+    d = z.Device.__new__(z.Device)
+    d._client = Stream(data)
+    d._cbor_hdr = bytearray(8)
+    d._ota_hdr = bytearray(4)
+    d._ota_buf = ota_buf
+    d.stats = _Stats()
+    d.log = lambda *args: None
+    return d
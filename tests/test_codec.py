@@ -0,0 +1,97 @@
+import os
+import struct
+
+import pytest
+
+from conftest import reader
+from sim import cbor, lzss
+
+
+def _frame_msg(z, msg):
+    buf = bytearray()
+    z._cbor_frame(buf, msg)
+    return buf
+
+
+def test_cbor_frames_decode_on_the_host(z):
+    msg = {"cmd": "EVNT", "payload": {"n": -3, "big": 1 << 40, "ok": True, "none": None, "s": "àé", "l": [1, "x"]}}
+    buf = _frame_msg(z, msg)
+    assert buf[0] == 3 and (buf[1] << 8 | buf[2]) == len(buf) - 3
+    assert cbor.decode(buf, 3)[0] == msg
+
+
+def test_cbor_floats_keep_seven_digits(z):
+    got = cbor.decode(_frame_msg(z, {"x": 0.1, "y": -2.5, "w": 123456789.0}), 3)[0]
+    assert got["x"] == pytest.approx(0.1) and got["y"] == -2.5
+    assert got["w"] == 123456800
+
+
+def test_cbor_unencodable_values_leave_the_buffer_as_it_was(z):
+    buf = bytearray(b"ab")
+    with pytest.raises(ValueError):
+        z._cbor_frame(buf, {"x": float("nan")})
+    assert buf == b"ab"
+
+
+def test_device_decodes_host_frames(z):
+    msg = {"cmd": "CALL", "id": 7, "method": "f", "args": [1, -1, "s", 2.5, [True, None]]}
+    d = reader(z, cbor.frame(msg)[1:])
+    assert d._getmsg(b"\x03") == msg
+
+
+def test_device_decodes_ieee_floats(z):
+    body = (b"\xa1\x61a\x84" + b"\xf9" + struct.pack(">e", 1.5) + b"\xfa" + struct.pack(">f", -0.25)
+            + b"\xfb" + struct.pack(">d", 123456789.125) + b"\xf9\x00\x01")
+    d = reader(z, bytes((0, len(body))) + body)
+    assert d._getmsg(b"\x03") == {"a": [1.5, -0.25, 123456789.125, 2.0 ** -24]}
+
+
+def test_device_skips_frames_it_cannot_decode(z):
+    # an infinity, then a valid frame: the stream stays in sync
+    bad = b"\xa2\x61a\xf9\x7c\x00\x61b\x01"
+    good = cbor.frame({"c": 2})
+    d = reader(z, bytes((0, len(bad))) + bad + good)
+    assert d._getmsg(b"\x03") == {}
+    assert d._getmsg() == {"c": 2}
+
+
+@pytest.mark.parametrize("head", [b"\x5a\x80\0\0\0", b"\x7a\x80\0\0\0", b"\x9a\x80\0\0\0", b"\xba\x80\0\0\0"])
+def test_device_rejects_lengths_past_the_frame(z, head):
+    body = head + b"xxxx"
+    d = reader(z, bytes((0, len(body))) + body)
+    with pytest.raises(IOError):
+        d._getmsg(b"\x03")
+
+
+def test_only_ota_blocks_use_the_update_buffer(z):
+    buf = bytearray(4)
+    block = cbor.frame({"cmd": "OTA", "t": "b", "b": 1, "raw": b"abcd"})
+    call = cbor.frame({"cmd": "CALL", "id": 1, "args": [b"abcd"], "raw": b"abcd"})
+    d = reader(z, block[1:] + call, ota_buf=buf)
+    assert d._getmsg(b"\x03")["raw"] is buf
+    msg = d._getmsg()
+    assert msg["raw"] is not buf and msg["args"][0] is not buf
+    assert buf == b"abcd"
+
+
+@pytest.mark.parametrize("w,l", [(8, 4), (10, 5), (4, 3)])
+def test_lz_decoder_matches_the_host_compressor(z, w, l):
+    data = os.urandom(300) + b"abcabcabc" * 200 + bytes(1000) + os.urandom(77)
+    packed = lzss.compress(data, w, l)
+    out = []
+    dec = z._LzDecoder(w, l, bytearray(512), lambda b: out.append(bytes(b)))
+    dec.reset(len(data))
+    # symbols span the pieces fed
+    for i in range(0, len(packed), 37):
+        dec.feed(packed[i:i + 37])
+    assert dec.finish()
+    assert b"".join(out) == data
+
+
+def test_lz_decoder_detects_short_streams(z):
+    data = b"hello world " * 50
+    packed = lzss.compress(data, 8, 4)
+    dec = z._LzDecoder(8, 4, bytearray(64), lambda b: None)
+    dec.reset(len(data))
+    dec.feed(packed[:len(packed) // 2])
+    assert not dec.finish()
@@ -0,0 +1,80 @@
+import os
+import time
+
+import pytest
+
+from conftest import connect
+from sim import bench
+from sim.stubs import fota
+
+CHUNK = 512
+
+
+def _update(z, adm, image, **kw):
+    uid, d = connect(z, adm, **kw)
+    job = adm.ota(uid, image, b"", chunk=CHUNK)
+    assert job.done.wait(30)
+    return d, job
+
+
+def _slot(image):
+    # the device stops before the reset: the new image is in the other bytecode slot
+    f = fota.flash
+    addr = f.bc_addr(1 - f.bc_slot)
+    return bytes(f.mem[addr:addr + len(image)])
+
+
+@pytest.mark.parametrize("adm_kw,dev_kw", [
+    ({}, {}),
+    ({"ota_window": 4, "icrc": True}, {}),
+    ({"ota_window": 4, "icrc": True, "frames": True, "reorder": True}, {}),
+    ({"ota_window": 4, "icrc": True, "compact": True}, {}),
+    ({"ota_window": 4, "icrc": True, "frames": True}, {"ota_erase": 4096}),
+    ({"ota_window": 4, "icrc": True, "frames": True}, {"ota_incremental": False}),
+    ({"ota_window": 4, "frames": True}, {"single_thread": True}),
+], ids=["stop-and-wait", "json", "frames-reordered", "cbor", "jit-erase", "full-crc", "single-thread"])
+def test_ota_writes_the_image(z, adm_factory, adm_kw, dev_kw):
+    image = os.urandom(20 * CHUNK + 100)
+    d, job = _update(z, adm_factory(**adm_kw), image, **dev_kw)
+    assert job.reason == "stopped by callback"
+    assert _slot(image) == image and fota.flash.bad_writes == 0
+
+
+def test_ota_delta_copies_unchanged_blocks(z, adm_factory):
+    f = fota.flash
+    base = os.urandom(32 * CHUNK)
+    f.load(f.bc_addr(f.bc_slot), base)
+    image = bytearray(base)
+    image[5 * CHUNK:5 * CHUNK + 10] = os.urandom(10)
+    d, job = _update(z, adm_factory(delta=True, ota_window=4, icrc=True, frames=True), bytes(image))
+    assert job.reason == "stopped by callback"
+    assert _slot(image) == image and job.blocks == 1 and d.stats.ota_copied == 31
+
+
+def test_ota_compressed(z, adm_factory):
+    image = bench._bytecode(40 * CHUNK)
+    d, job = _update(z, adm_factory(lz=(8, 4), ota_window=4, icrc=True, frames=True), image)
+    assert job.reason == "stopped by callback"
+    assert _slot(image) == image and job.bytes < len(image)
+
+
+def test_ota_fails_at_once_on_compression_it_cannot_decode(z, adm_factory):
+    d, job = _update(z, adm_factory(lz=(8, 8), ota_window=4, frames=True), bench._bytecode(8 * CHUNK))
+    assert job.reason == "Bad compression" and job.blocks == 0
+
+
+def test_failed_heartbeat_reconnects(z, adm_factory):
+    adm = adm_factory()
+    uid, d = connect(z, adm, low_res=True, heartbeat=1, backoff_min=100, backoff_max=100)
+    logins = adm.logins
+    writes = []
+
+    def broken(data):
+        writes.append(len(data))
+        raise OSError("broken link")
+
+    d._client.write = broken
+    deadline = time.monotonic() + 5
+    while adm.logins == logins and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert adm.logins > logins and len(writes) < 5
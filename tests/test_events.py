@@ -0,0 +1,108 @@
+import time
+
+from conftest import connect
+from sim.stubs.zbuiltins import QueueFull
+
+
+def _evnt(i):
+    return {"cmd": "EVNT", "payload": i}
+
+
+def _stored(s):
+    out = []
+    while s.count:
+        out.append(s.peek()["payload"])
+        s.pop()
+    return out
+
+
+def test_store_policies(z):
+    s = z.EventStore(size=3)
+    for i in range(5):
+        s.put(_evnt(i))
+    assert _stored(s) == [2, 3, 4] and s.dropped == 2 and s.removed == 5
+    s = z.EventStore(size=3, policy=z.DROP_NEWEST)
+    for i in range(5):
+        s.put(_evnt(i))
+    assert _stored(s) == [0, 1, 2] and s.dropped == 2
+
+
+def test_store_records_have_a_fixed_size(z):
+    s = z.EventStore(size=3, record=40)
+    assert len(s._ring) == 120
+    for i in range(3):
+        s.put(_evnt(i))
+    # too long: dropped without evicting a stored event
+    assert not s.put(_evnt("x" * 50))
+    assert s.count == 3 and s.dropped == 1
+    assert _stored(s) == [0, 1, 2]
+
+
+def test_pop_checks_the_event_peeked(z):
+    s = z.EventStore(size=2)
+    s.put(_evnt(0))
+    removed = s.removed
+    s.peek()
+    s.put(_evnt(1))
+    s.put(_evnt(2))
+    s.pop(removed)
+    assert _stored(s) == [1, 2]
+
+
+def test_file_store_survives_a_reset(z, tmp_path):
+    path = str(tmp_path / "events")
+    s = z.FileEventStore(path, size=3, record=64)
+    for i in range(4):
+        s.put(_evnt(i))
+    assert not s.put(_evnt("x" * 100))
+    assert s.count == 3 and s.dropped == 2
+    s = z.FileEventStore(path, size=3, record=64)
+    assert _stored(s) == [1, 2, 3]
+
+
+class _Device():
+    ts = 0
+    _ts_local = 0
+
+    def __init__(self):
+        self.full = True
+        self.sent = []
+
+    def log(self, *args):
+        pass
+
+    def send(self, msg):
+        if self.full:
+            raise QueueFull
+        self.sent.append(msg)
+
+
+def test_batcher_keeps_full_batches_and_sends_them_by_age(z):
+    d = _Device()
+    b = z.EventBatcher(d, size=2, age=100)
+    b.add(1)
+    # the flush fails: the payload is kept, not raised to the application
+    b.add(2)
+    assert len(b.records) == 2
+    d.full = False
+    deadline = time.monotonic() + 2
+    while not d.sent and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [p for _, p in d.sent[0]["payload"]] == [1, 2] and not b.records
+
+
+def test_stored_events_are_forwarded_after_login(z, adm_factory):
+    for mode in ({}, {"low_res": True}, {"single_thread": True}):
+        adm = adm_factory()
+        uid, d = connect(z, adm, store=z.EventStore(8), store_rate=50, backoff_min=100, backoff_max=100, **mode)
+        adm.kill(uid)
+        while d.logged:
+            time.sleep(0.001)
+        for i in range(3):
+            d.send_event({"i": i})
+        assert d.store.count == 3
+        adm.wait_login(uid)
+        deadline = time.monotonic() + 5
+        while len(adm.events) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert [m["payload"]["i"] for _, _, m in adm.events if m["cmd"] == "EVNT"] == [0, 1, 2]
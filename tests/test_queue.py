@@ -0,0 +1,79 @@
+import time
+
+import pytest
+
+from conftest import connect
+from sim.stubs import queue
+from sim.stubs.zbuiltins import QueueEmpty, QueueFull
+
+
+def _evnt(i):
+    return {"cmd": "EVNT", "payload": i}
+
+
+def _drain(q):
+    out = []
+    while True:
+        try:
+            out.append(q.get(False))
+        except QueueEmpty:
+            return out
+
+
+def test_urgent_messages_go_first(z):
+    q = z.OutQueue()
+    q.put(_evnt(1))
+    q.put({"cmd": "RETN", "id": 1, "res": 0})
+    q.put(_evnt(2))
+    assert [m["cmd"] for m in _drain(q)] == ["RETN", "EVNT", "EVNT"]
+
+
+def test_block_raises_when_full_and_not_waiting(z):
+    q = z.OutQueue(sizes=(1, 1))
+    q.put(_evnt(1))
+    with pytest.raises(QueueFull):
+        q.put(_evnt(2), False)
+    with pytest.raises(QueueFull):
+        q.put(_evnt(2), True, 20)
+
+
+def test_drop_policies(z):
+    q = z.OutQueue(sizes=(1, 2), policies=(z.BLOCK, z.DROP_OLDEST))
+    for i in range(4):
+        q.put(_evnt(i))
+    assert [m["payload"] for m in _drain(q)] == [2, 3] and q.drops == [0, 2]
+    q = z.OutQueue(sizes=(1, 2), policies=(z.BLOCK, z.DROP_NEWEST))
+    for i in range(4):
+        q.put(_evnt(i))
+    assert [m["payload"] for m in _drain(q)] == [0, 1] and q.drops == [0, 2]
+
+
+def test_keep_latest_replaces_by_key(z):
+    q = z.OutQueue(sizes=(1, 2), policies=(z.BLOCK, z.KEEP_LATEST))
+    q.put(_evnt("t1"), key="temp")
+    q.put(_evnt("h1"), key="hum")
+    q.put(_evnt("t2"), key="temp")
+    assert [m["payload"] for m in _drain(q)] == ["t2", "h1"] and q.drops == [0, 0]
+
+
+def test_limits_hold_a_key_without_delaying_others(z):
+    q = z.OutQueue(sizes=(4, 4), limits={"temp": (10, 1)})
+    q.put(_evnt("t1"), key="temp")
+    q.put(_evnt("t2"), key="temp")
+    q.put(_evnt("h1"), key="hum")
+    q.put({"cmd": "RETN", "id": 1, "res": 0})
+    assert [m["payload"] if "payload" in m else m["cmd"] for m in _drain(q)] == ["RETN", "t1", "h1"]
+    t0 = time.monotonic()
+    assert q.get(True, 1000)["payload"] == "t2"
+    assert time.monotonic() - t0 >= 0.05
+
+
+def test_queue_queue_can_be_the_outq(z, adm_factory):
+    adm = adm_factory()
+    uid, d = connect(z, adm, outq=queue.Queue(4))
+    d.send_event({"a": 1})
+    d.send_notification("t", "x")
+    deadline = time.monotonic() + 5
+    while len(adm.events) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [m["cmd"] for _, _, m in adm.events] == ["EVNT", "NTFY"]
@@ -0,0 +1,85 @@
+import time
+
+from conftest import connect
+from sim.stubs import timers, zbuiltins
+
+
+def test_cache_finds_calls_by_id_and_method(z):
+    c = z._RpcCache(4, 60000)
+    e = c.add(1, "f")
+    assert c.get(1, "f") is e and e[2] is None
+    assert c.get(1, "g") is None and c.get(2, "f") is None
+
+
+def test_cache_expires_answered_calls_only(z):
+    c = z._RpcCache(4, 0)
+    running = c.add(1, "f")
+    done = c.add(2, "f")
+    done[2], done[3], done[4] = "res", 5, timers.now()
+    assert c.get(2, "f") is None
+    assert c.get(1, "f") is running
+
+
+def test_cache_discards_running_calls_last(z):
+    c = z._RpcCache(2, 60000)
+    running = c.add(1, "f")
+    done = c.add(2, "f")
+    done[2] = "res"
+    c.add(3, "f")
+    assert c.get(1, "f") is running and c.get(2, "f") is None
+
+
+def _call(adm, uid, method, cid=None):
+    c = adm.call(uid, method, cid=cid)
+    assert c["done"].wait(5)
+    return c
+
+
+def test_retries_get_the_cached_result(z, adm_factory):
+    adm = adm_factory()
+    runs = []
+    uid, d = connect(z, adm, rpc={"f": lambda: runs.append(1) or len(runs)}, rpc_cache=8)
+    c = _call(adm, uid, "f")
+    r = _call(adm, uid, "f", c["id"])
+    assert c["reply"]["res"] == r["reply"]["res"] == 1 and len(runs) == 1
+
+
+def test_a_late_result_replaces_the_timeout(z, adm_factory):
+    adm = adm_factory()
+    runs = []
+
+    def slow():
+        time.sleep(0.3)
+        runs.append(1)
+        return 42
+
+    uid, d = connect(z, adm, rpc={"slow": slow}, rpc_workers=1, rpc_timeout={"slow": 100}, rpc_cache=8)
+    c = _call(adm, uid, "slow")
+    assert c["reply"]["error"] == "timeout"
+    time.sleep(0.4)
+    r = _call(adm, uid, "slow", c["id"])
+    assert r["reply"].get("res") == 42 and len(runs) == 1
+
+
+def test_endpoints_fail_over_and_stay(z):
+    e = z.Endpoints([("10.0.0.1", 1), ("10.0.0.2", 2)])
+    assert e.pick() == 0
+    assert e.failure()
+    assert e.pick() == 1
+    e.success()
+    assert e.pick() == 1
+    # both failed: nothing ready at once
+    assert not e.failure()
+
+
+def test_endpoints_cache_resolved_names(z):
+    resolver = zbuiltins.__dict__["__default_net"]["sock"][0]
+    resolver.hosts["adm.test"] = "10.0.0.9"
+    e = z.Endpoints([("adm.test", 1)], ttl=60000)
+    before = resolver.lookups
+    i = e.pick()
+    assert e.resolve(i) == "10.0.0.9" and e.resolve(i) == "10.0.0.9"
+    assert resolver.lookups - before == 1 and e.lookups == 1
+    e.failure()
+    e.resolve(e.pick())
+    assert e.lookups == 2
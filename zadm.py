@@ -9,7 +9,7 @@ Zerynth ADM Library
 
 The Zerynth ADM library can be used yo ease the connection to the :ref:`Zerynth ADM sandbox <zadm>`.
 It takes care of connecting to the ADM and listening for incoming messages. Moreover it seamlessly enables RPC calls and mobile integration.
-For Virtual Machines supporting FOTA updates, the Zerynth ADM also performs the FOTA process automatically when requested.
+For Virtual Machines supporting FOTA updates, the Zerynth ADM also performs the FOTA process automatically when requested. If the connection drops during an update of the same images (as identified by the ADM), the transfer continues from the first missing block after reconnection. Blocks unchanged from the running firmware can be copied locally instead of transferred (delta updates).
 
 ========================
 Zerynth ADM Step by Step
@@ -49,20 +49,310 @@ __define(__OTA_RECEIVING_VM,3)
 __define(__OTA_RECEIVING_BC_CRC,4)
 __define(__OTA_RECEIVING_VM_CRC,5)
 
+# binary frames: type byte, 16 bit block index, 16 bit length (big endian), data
+__define(__FRAME_BC,1)
+__define(__FRAME_VM,2)
+# compact message: type byte, 16 bit length (big endian), CBOR encoded message
+__define(__FRAME_CBOR,3)
+
+# blocks of the running slot whose crcs are reported with each message of a delta update
+__define(__OTA_HASHES,32)
+
+# crc32 (same as zlib), four bits at a time to keep the table small
+_crc_table = (
+    0x00000000,0x1db71064,0x3b6e20c8,0x26d930ac,0x76dc4190,0x6b6b51f4,0x4db26158,0x5005713c,
+    0xedb88320,0xf00f9344,0xd6d6a3e8,0xcb61b38c,0x9b64c2b0,0x86d3d2d4,0xa00ae278,0xbdbdf21c
+)
+
+def _crc32(crc,data):
+    crc = crc^0xffffffff
+    for b in data:
+        crc = (crc>>4)^_crc_table[(crc^b)&15]
+        crc = (crc>>4)^_crc_table[(crc^(b>>4))&15]
+    return crc^0xffffffff
+
+def _block_crc(b,data):
+    # crc32 of the block index (4 bytes, big endian) followed by the block data.
+    # The image digest is the xor of all block crcs, so blocks can be added in any order
+    crc = 0xffffffff
+    for sh in (24,16,8,0):
+        x = (b>>sh)&255
+        crc = (crc>>4)^_crc_table[(crc^x)&15]
+        crc = (crc>>4)^_crc_table[(crc^(x>>4))&15]
+    return _crc32(crc^0xffffffff,data)
+
+# compact encoding: a CBOR subset (RFC 7049) written into bytearrays and decoded straight
+# from the stream (see Device._cbor_item). Floats are decimal fractions (tag 4) with 7
+# significant digits, so no packing of IEEE values is needed; values of other types raise ValueError
+def _cbor_head(buf,major,n):
+    major = major<<5
+    if n<24:
+        buf.append(major|n)
+    elif n<0x100:
+        buf.append(major|24)
+        buf.append(n)
+    elif n<0x10000:
+        buf.append(major|25)
+        buf.append(n>>8)
+        buf.append(n&255)
+    elif n<0x100000000:
+        buf.append(major|26)
+        for sh in (24,16,8,0):
+            buf.append((n>>sh)&255)
+    elif n<0x10000000000000000:
+        buf.append(major|27)
+        for sh in (56,48,40,32,24,16,8,0):
+            buf.append((n>>sh)&255)
+    else:
+        raise ValueError
+
+def _cbor_float(buf,x):
+    if x!=x or x-x!=0:
+        # nan and infinities
+        raise ValueError
+    m = -x if x<0 else x
+    e = 0
+    if m:
+        while m>=10000000:
+            m = m/10
+            e+=1
+        while m<1000000:
+            m = m*10
+            e-=1
+    m = int(m+0.5)
+    while m and m%10==0:
+        m = m//10
+        e+=1
+    buf.append(0xc4)
+    buf.append(0x82)
+    _cbor_enc(buf,e)
+    _cbor_enc(buf,-m if x<0 else m)
+
+def _cbor_enc(buf,obj):
+    if obj is None:
+        buf.append(0xf6)
+    elif obj is True:
+        buf.append(0xf5)
+    elif obj is False:
+        buf.append(0xf4)
+    elif isinstance(obj,int):
+        if obj<0:
+            _cbor_head(buf,1,-1-obj)
+        else:
+            _cbor_head(buf,0,obj)
+    elif isinstance(obj,float):
+        _cbor_float(buf,obj)
+    elif isinstance(obj,str):
+        bb = obj.encode("utf-8")
+        _cbor_head(buf,3,len(bb))
+        buf.extend(bb)
+    elif isinstance(obj,bytes) or isinstance(obj,bytearray):
+        _cbor_head(buf,2,len(obj))
+        buf.extend(obj)
+    elif isinstance(obj,list) or isinstance(obj,tuple):
+        _cbor_head(buf,4,len(obj))
+        for x in obj:
+            _cbor_enc(buf,x)
+    elif isinstance(obj,dict):
+        _cbor_head(buf,5,len(obj))
+        for k in obj:
+            _cbor_enc(buf,k)
+            _cbor_enc(buf,obj[k])
+    else:
+        raise ValueError
+
+def _cbor_ieee(x,ebits,mbits):
+    # the value of the IEEE 754 float with bits x; infinities and nan have no JSON counterpart
+    bias = (1<<(ebits-1))-1
+    e = (x>>mbits)&((1<<ebits)-1)
+    m = x&((1<<mbits)-1)
+    if e==(1<<ebits)-1:
+        raise ValueError
+    if e:
+        f = (m|(1<<mbits))*2.0**(e-bias-mbits)
+    else:
+        f = m*2.0**(1-bias-mbits)
+    return -f if x>>(ebits+mbits) else f
+
+# strings of OTA block messages, returned by the decoder instead of new ones
+_cbor_names = ("cmd","OTA","t","b","v","raw")
+
+def _cbor_frame(buf,msg):
+    # append msg to buf as a compact frame; on error buf is left as it was
+    start = len(buf)
+    buf.append(__FRAME_CBOR)
+    buf.append(0)
+    buf.append(0)
+    try:
+        _cbor_enc(buf,msg)
+        n = len(buf)-start-3
+        if n>=0x10000:
+            raise ValueError
+    except Exception as e:
+        del buf[start:]
+        raise ValueError
+    buf[start+1] = n>>8
+    buf[start+2] = n&255
+
+# compressed FOTA images: LZSS in the heatshrink format. Each symbol is a bit set followed by
+# a literal byte, or a bit clear followed by offset-1 (w bits) and length-1 (l bits) of a
+# match in the last 2**w bytes decoded; bits are packed msb first
+class _LzDecoder():
+
+    def __init__(self,w,l,out,flush):
+        self.w = w
+        self.l = l
+        self.win = bytearray(1<<w)
+        self.out = out
+        self.flush = flush # called with out each time it is full
+
+    def reset(self,size):
+        # start a new stream decoding to size bytes
+        for i in range(len(self.win)):
+            self.win[i] = 0
+        self.pos = 0
+        self.n = 0 # bytes in out
+        self.left = size
+        self.acc = 0
+        self.nacc = 0
+        self.need = 1
+        self.state = 0 # 0 tag, 1 literal, 2 offset, 3 length
+        self.off = 0
+
+    def feed(self,data):
+        # the state is kept in locals while decoding, symbols can span calls
+        win = self.win
+        mask = len(win)-1
+        out = self.out
+        size = len(out)
+        pos = self.pos
+        n = self.n
+        left = self.left
+        acc = self.acc
+        nacc = self.nacc
+        need = self.need
+        state = self.state
+        for x in data:
+            acc = (acc<<8)|x
+            nacc+=8
+            while nacc>=need:
+                nacc-=need
+                v = acc>>nacc
+                acc&=(1<<nacc)-1
+                if state==0:
+                    if v:
+                        state = 1
+                        need = 8
+                    else:
+                        state = 2
+                        need = self.w
+                    continue
+                if state==2:
+                    self.off = v+1
+                    state = 3
+                    need = self.l
+                    continue
+                if state==1:
+                    k = 1
+                    src = -1
+                else:
+                    k = v+1
+                    src = (pos-self.off)&mask
+                while k and left:
+                    c = v if src<0 else win[src&mask]
+                    src+=1
+                    win[pos] = c
+                    pos = (pos+1)&mask
+                    out[n] = c
+                    n+=1
+                    if n==size:
+                        self.flush(out)
+                        n = 0
+                    left-=1
+                    k-=1
+                state = 0
+                need = 1
+        self.pos = pos
+        self.n = n
+        self.left = left
+        self.acc = acc
+        self.nacc = nacc
+        self.need = need
+        self.state = state
+
+    def finish(self):
+        # flush the last bytes, returns True if the stream decoded to the expected size
+        if self.n:
+            self.flush(self.out[:self.n])
+            self.n = 0
+        return self.left==0
+
+# results of recent RPC calls, least recently used first. An entry is
+# [id,method,key,value,time], key being None while the call is running.
+# Entries are added and looked up by the reader thread only
+class _RpcCache():
+
+    def __init__(self,size,ttl):
+        self.size = size
+        self.ttl = ttl
+        self.items = []
+
+    def get(self,cid,method):
+        # the entry of the call, now the most recently used, dropping expired ones on the way
+        now = timers.now()
+        i = 0
+        while i<len(self.items):
+            e = self.items[i]
+            if e[2] is not None and now-e[4]>=self.ttl:
+                self.items.pop(i)
+                continue
+            if e[0]==cid and e[1]==method:
+                self.items.pop(i)
+                self.items.append(e)
+                return e
+            i+=1
+        return None
+
+    def add(self,cid,method):
+        if len(self.items)>=self.size:
+            # running calls are discarded last
+            i = 0
+            while i<len(self.items)-1 and self.items[i][2] is None:
+                i+=1
+            self.items.pop(i)
+        e = [cid,method,None,None,timers.now()]
+        self.items.append(e)
+        return e
+
+    def remove(self,e):
+        if e in self.items:
+            self.items.remove(e)
+
+# overflow policies of OutQueue
+BLOCK = 0
+DROP_OLDEST = 1
+DROP_NEWEST = 2
+KEEP_LATEST = 3
+
+# connection states
+DISCONNECTED = 0
+CONNECTING = 1
+CONNECTED = 2
+
 class Device():
     """
 ================
 The Device class
 ================
 
-.. class:: Device(uid,token,ip=None,address="things.zerynth.com",heartbeat=60,rpc=None,log=False,fota_callback=None,low_res=False)
+.. class:: Device(uid,token,ip=None,address="things.zerynth.com",heartbeat=60,rpc=None,log=False,fota_callback=None,low_res=False,ota_window=4,ota_full_crc=False,ota_incremental=True,ota_erase=0,batch_size=512,batch_wait=0,outq=None,rpc_workers=0,rpc_pending=4,rpc_timeout=None,single_thread=False,poll=100,backoff_min=1000,backoff_max=60000,state_callback=None,store=None,store_rate=10,compact=False,stats_rpc=False,ota_delta=True,ota_lz=8,ping=10000,read_timeout=5000,keepalive=20000,endpoints=None,dns_ttl=300000,rpc_cache=0,rpc_cache_ttl=60000)
 
         Creates a Device instance with uid :samp:`uid` and token :samp:`token`. All other parameters are optional and have default values.
 
         * :samp:`ip` is the ip address of the ADM. This argument is used when the network driver does not support hostname resolution
         * :samp:`address` is the hostname of the ADM instance. It is used by default and resolved to an ip address when the network driver supports the functionality
-        * :samp:`heartbeat` is the number of seconds between heartbeat messages. If the ADM detects that a connected device is not sending heartbeat messages two times in a row, it automatically terminates the connection. Heartbeat messages are automatically sent by the Device class. The ADM may not accept the specified heartbeat time and force the device to use another, based on network traffic and other parameters.
-        * :samp:`rpc` is a dictionary with keys representing function names and values representing actual Python functions. When a RPC call is made to the ADM, the message is relayed to the connected device. The Device class, scans the :samp:`rpc` dictionary and if a key matching the requested call is found, the corresponding function is executed (in the Device class thread). The result (or the exception message) is then sent back to the ADM that relays it to the caller.
+        * :samp:`heartbeat` is the number of seconds between heartbeat messages. If the ADM detects that a connected device is not sending heartbeat messages two times in a row, it automatically terminates the connection. Heartbeat messages are automatically sent by the Device class, only when no other message has been sent for :samp:`heartbeat` seconds. The ADM may not accept the specified heartbeat time and force the device to use another, based on network traffic and other parameters.
+        * :samp:`rpc` is a dictionary with keys representing function names and values representing actual Python functions. When a RPC call is made to the ADM, the message is relayed to the connected device. The Device class, scans the :samp:`rpc` dictionary and if a key matching the requested call is found, the corresponding function is executed (in the Device class thread, or in a worker thread when :samp:`rpc_workers` is given). The result (or the exception message) is then sent back to the ADM that relays it to the caller.
         * :samp:`log`, if true prints logging messages to the device serial console
         * :samp:`fota_callback`, is a function accepting one ore more arguments that will be called at different steps of the FOTA process. The argument will be set to:
 
@@ -73,9 +363,36 @@ The Device class
             the :samp:`fota_callback` can return a boolean value. If the return value is True, the FOTA process continues, otherwise it is stopped.
 
         * :samp:`low_res`, if true makes the FOTA process a bit less performant but more lightweight (needed for low-resource devices)
+        * :samp:`ota_window`, is the maximum number of FOTA blocks the device keeps requested at the same time. It is advertised at login and the ADM chooses the actual window for each update: blocks may then arrive in any order and are written at their own offset. ADMs without window support transfer one block at a time.
+        * :samp:`ota_full_crc`, if true the whole slot checksum is verified also when the ADM supports incremental checks. Otherwise the FOTA image is verified against a digest updated as blocks are written, avoiding to read back the slot at the end of the transfer.
+        * :samp:`ota_incremental`, if false the device does not offer the incremental digest at login and FOTA images are always verified with the whole slot checksum. The digest is computed in Python over every byte of each block by the thread receiving them: disable it on devices where a per-byte Python CRC is slower than reading back the slot with the native checksum. Delta updates compute the same CRC over the running slot, consider disabling :samp:`ota_delta` as well.
+        * :samp:`ota_delta`, if true the device offers delta FOTA updates at login. In a delta update the device reports the crc of each block of the running slot, the ADM answers with the blocks that are unchanged in the new image and only the others are transferred: unchanged blocks are copied from the running slot. Both the incremental and the full checksum verify the result as usual.
+        * :samp:`ota_lz`, is the base 2 logarithm of the largest decompression window the device accepts for compressed FOTA updates, zero to disable them. The ADM may send the images compressed (LZSS, heatshrink format) with a window up to this size, decoded as blocks arrive and written to flash chunk by chunk: decoding needs a window of :samp:`2**ota_lz` bytes and a chunk buffer. Compression is not used together with delta updates: an update asking for both, or for a window or length the device can't decode, fails at once.
+        * :samp:`ota_erase`, if zero the FOTA slots are entirely erased before the first block is requested. Otherwise it is the size in bytes of the flash area erased at a time, just before the blocks landing there are requested, so that erasing overlaps with the transfer. It must be a multiple of the flash sector size and is not suitable for flashes with sectors of different sizes.
+        * :samp:`batch_size`, is the number of bytes after which queued messages are sent. Messages waiting to be sent are serialized together and sent to the ADM with a single socket write, up to this size.
+        * :samp:`batch_wait`, is the number of milliseconds the device waits for more messages before sending a batch. The default of zero sends immediately what is already queued.
+        * :samp:`outq`, is the queue of outgoing messages. By default an :class:`OutQueue` is created where RPC results, heartbeats and FOTA messages are kept ahead of events and notifications. An :class:`OutQueue` with :samp:`limits` bounds the rate of events and notifications whatever the application does. Any queue with the :samp:`put` and :samp:`get` methods of :samp:`queue.Queue` can be given, as long as messages are sent without a :samp:`key`.
+        * :samp:`rpc_workers`, is the number of threads executing RPC calls. If zero, calls are executed one at a time by the thread reading incoming messages, that is blocked until the call returns.
+        * :samp:`rpc_pending`, is the maximum number of RPC calls waiting for a free worker. Further calls are answered with a "busy" error.
+        * :samp:`rpc_timeout`, is a dictionary with keys representing function names and values representing the milliseconds a call can last. When a call takes longer, a "timeout" error is sent back as its result and the late result is discarded.
+        * :samp:`rpc_cache`, is the number of recent RPC results kept by call id, zero to disable the cache. A call arriving again with the same id and method (as retried by the ADM after a result lost with the connection) is answered with the kept result or error, without executing the function again; while the first call is still running, the duplicate is ignored. A result arriving after the call timed out (see :samp:`rpc_timeout`) replaces the kept timeout error. The least recently used result is discarded to make room.
+        * :samp:`rpc_cache_ttl`, is the number of milliseconds a result is kept after being sent.
+        * :samp:`single_thread`, if true a single background thread reads incoming messages, sends queued messages and heartbeats, saving the memory of two threads. It takes precedence over :samp:`low_res`.
+        * :samp:`poll`, is the maximum number of milliseconds the single thread waits for incoming messages before checking for messages to send.
+        * :samp:`backoff_min` and :samp:`backoff_max`, are the bounds in milliseconds of the delay between connection attempts. The delay doubles at each failed attempt and a random part of it is skipped, so that many devices losing the connection at the same time do not retry all together.
+        * :samp:`state_callback`, is a function called with the new connection state (:samp:`DISCONNECTED`, :samp:`CONNECTING` or :samp:`CONNECTED`) every time it changes.
+        * :samp:`store`, is an :class:`EventStore` (or :class:`FileEventStore`) where events are kept while the device is not connected or the queue of outgoing messages is full. Stored events are sent after login, oldest first, together with the events sent meanwhile, that are not stored and may arrive before older stored ones.
+        * :samp:`store_rate`, is the maximum number of stored events sent per second, so that the backlog does not take the whole link after a reconnection. Events sent while connected are not limited by it.
+        * :samp:`compact`, if true the device offers at login a compact binary encoding of messages (a subset of CBOR, sent as length prefixed frames). When the ADM accepts it, all messages are encoded and decoded directly into byte buffers, without the JSON strings. Floats are encoded with 7 significant digits, so float values may differ from those sent as JSON: for this reason the encoding is not offered by default. Messages that can't be encoded are sent as JSON, and incoming frames with items the device can't decode are skipped.
+        * :samp:`ping`, is the number of milliseconds without incoming messages after which the device sends a ping to the ADM, if the ADM accepted pings at login. Zero disables pings.
+        * :samp:`read_timeout`, is the number of milliseconds within which a message must be completely received once started, and the ADM must answer a ping. A broken link is thus detected and the connection established again at most :samp:`ping+read_timeout` milliseconds after the last message received, even when writes still succeed (half open connections after NAT timeouts or handovers). Zero disables read deadlines and pings.
+        * :samp:`keepalive`, is the number of milliseconds of idle connection after which TCP keepalive probes are sent, when the network driver supports them. Zero disables keepalive.
+        * :samp:`endpoints`, is a list of :samp:`(address,port)` tuples of ADM nodes, used instead of :samp:`ip`, :samp:`address` and :samp:`port`. Connections go to the healthiest node and fail over to the others when it can't be reached, without waiting for the connection backoff as long as there are nodes not failed yet (see :class:`Endpoints`). Current node and address are in :samp:`address`, :samp:`port` and :samp:`ip`.
+        * :samp:`dns_ttl`, is the number of milliseconds a resolved address is reused before resolving the hostname again.
+        * :samp:`stats_rpc`, if true the reserved RPC :samp:`__stats` returns the content of :samp:`stats` (see :class:`Stats`), so that devices can be monitored remotely without logging.
 
     """
-    def __init__(self,uid,token,ip=None,port=12345,address="things.zerynth.com",heartbeat=60,rpc=None,log=False,fota_callback=None,low_res=False):
+    def __init__(self,uid,token,ip=None,port=12345,address="things.zerynth.com",heartbeat=60,rpc=None,log=False,fota_callback=None,low_res=False,ota_window=4,ota_full_crc=False,ota_incremental=True,ota_erase=0,batch_size=512,batch_wait=0,outq=None,rpc_workers=0,rpc_pending=4,rpc_timeout=None,single_thread=False,poll=100,backoff_min=1000,backoff_max=60000,state_callback=None,store=None,store_rate=10,compact=False,stats_rpc=False,ota_delta=True,ota_lz=8,ping=10000,read_timeout=5000,keepalive=20000,endpoints=None,dns_ttl=300000,rpc_cache=0,rpc_cache_ttl=60000):
         self.heartbeat = heartbeat
         self.address = address
         self.port = port
@@ -83,9 +400,26 @@ The Device class
             self.rpc = {}
         else:
             self.rpc = rpc
+        self.rpc_workers = rpc_workers
+        self.rpc_pending = rpc_pending
+        self.rpc_timeout = rpc_timeout
+        self._rpcq = None
+        self._rpc_lock = threading.Lock()
+        self._rpc_cache = _RpcCache(rpc_cache,rpc_cache_ttl) if rpc_cache else None
         self.logged = False
         self.reconnecting = False
-        self.wq = queue.Queue(maxsize=2)
+        self.state = DISCONNECTED
+        self.state_callback = state_callback
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self._retry = 0
+        self._gen = 0
+        self._lock = threading.Lock()
+        self._link = threading.Condition(self._lock)
+        if not outq:
+            self.wq = OutQueue()
+        else:
+            self.wq = outq
         if log:
             self.log = self._log
         else:
@@ -96,12 +430,58 @@ The Device class
         self._rth = None
         self._hth = None
         self._wth = None
+        self._whth = None
         self.ts = 0
+        self._ts_local = 0
         self.ip = ip
         self.ota = __OTA_IDLE
         self.ota_type = __OTA_ONLY_BC
         self.fota_callback = fota_callback
         self.low_res = low_res
+        self.single_thread = single_thread
+        self.poll = poll
+        self._last_tx = 0 # time of the last message sent
+        self.ota_window = ota_window
+        self.ota_full_crc = ota_full_crc
+        self.ota_incremental = ota_incremental
+        self.ota_erase = ota_erase
+        self.batch_size = batch_size
+        self._wbuf = bytearray() # reused by every batch, emptied before each
+        self._sbuf = bytearray() # the same for single messages
+        self.batch_wait = batch_wait
+        self.ota_icrc = False
+        self.ota_id = None # images of the current update, as named by the ADM
+        self._ota_buf = None # block buffer, allocated once per update
+        self._ota_hdr = bytearray(4)
+        self._cbor_hdr = bytearray(8) # heads of compact items
+        self._cbor_left = 0 # bytes of the compact frame being decoded
+        self._ota_msg = {"cmd":"OTA","t":"b","b":0,"raw":None}
+        self.ota_delta = ota_delta
+        self.ota_cur = None # fota record of the running slots, during a delta update
+        self.ota_same = None # bit per block, set when the block is copied from the running slot
+        self.ota_lz = ota_lz
+        self.ota_zinfo = None # compression of the update: window and length bits, compressed sizes
+        self.ota_z = 0 # compressed size of the part being received, 0 if sent as is
+        self._lz = None
+        self.store = store
+        self.store_rate = store_rate
+        self._fwd_ms = max(1,1000//store_rate) # interval between stored events sent
+        self._fwd_t = 0 # time of the last stored event sent
+        self.compact = compact
+        self._enc = False # compact encoding accepted by the ADM
+        self.stats = Stats(self)
+        self.stats_rpc = stats_rpc
+        self.ping = ping
+        self.read_timeout = read_timeout
+        self.keepalive = keepalive
+        self._pings = False # pings accepted by the ADM
+        self._last_rx = 0 # time the last message started arriving
+        self._ping_t = 0 # time the last ping was sent
+        if not endpoints:
+            # a single node: the ip address if given, otherwise the hostname
+            endpoints = [(ip if ip else address,port)]
+        self.endpoints = Endpoints(endpoints,dns_ttl)
+        self._failover = False # the last attempt failed and another node can be tried at once
 
     def _log(self,*args):
         print(timers.now(),*args)
@@ -115,38 +495,134 @@ The Device class
 .. method:: start()
 
         Starts the connection process and creates background threads to handle incoming and outgoing messages.
-        It returns immediately.
+        It returns immediately: the connection is established, and established again when lost, in background. Use :meth:`wait_connected` or :samp:`state_callback` to know when the device is connected.
                 
         """
-        while not self.logged:
-            self.logged = self.login()
-            sleep(5000)
         if self._rth is None:
-            self._rth = thread(self._readloop)
+            if self.single_thread:
+                self._rth = thread(self._loop)
+            else:
+                self._rth = thread(self._readloop)
+        if self.rpc_workers and self._rpcq is None:
+            self._rpcq = queue.Queue(maxsize=self.rpc_pending)
+            for i in range(self.rpc_workers):
+                thread(self._rpcloop)
 
-        if not self.low_res:
+        if self.single_thread:
+            # the loop thread also writes and sends heartbeats
+            pass
+        elif not self.low_res:
             if self._hth is None:
                 self._hth = thread(self._htbm)
             if self._wth is None:
                 self._wth = thread(self._writeloop)
-        else:
+        elif self._whth is None:
             self._whth = thread(self._writeloop_htbm)
-        self.reconnecting=False
+
+    def wait_connected(self,timeout=-1):
+        """
+.. method:: wait_connected(timeout=-1)
+
+        Waits for the device to be connected to the ADM, for at most :samp:`timeout` milliseconds (forever if negative). Returns True if the device is connected.
+                
+        """
+        self._lock.acquire()
+        deadline = timers.now()+timeout
+        while not self.logged:
+            if timeout<0:
+                self._link.wait()
+            elif deadline<=timers.now():
+                break
+            else:
+                self._link.wait(deadline-timers.now())
+        res = self.logged
+        self._lock.release()
+        return res
+
+    def _set_state(self,state):
+        if state==self.state:
+            return
+        self.stats._state(self.state,state)
+        self.state = state
+        if self.state_callback:
+            try:
+                self.state_callback(state)
+            except Exception as e:
+                self.log("Exception in state callback",e)
+
+    def _connect(self):
+        # called by the thread owning the connection (reader or single loop): the only one logging in
+        while not self.logged:
+            if self._retry and not self._failover:
+                delay = min(self.backoff_max,self.backoff_min<<min(self._retry-1,16))
+                delay = random(delay//2,delay)
+                self.log("Connecting in",delay)
+                sleep(delay)
+            self._set_state(CONNECTING)
+            if self.login():
+                self.endpoints.success()
+                self._last_tx = timers.now()
+                self._last_rx = self._last_tx
+                self._lock.acquire()
+                self._retry = 0
+                self._gen+=1
+                self.logged = True
+                self.reconnecting = False
+                self._link.notify_all()
+                self._lock.release()
+                self._set_state(CONNECTED)
+                if self.store is not None and self.store.count and not self.single_thread:
+                    # the writer may be waiting for a message since before the events were stored:
+                    # a heartbeat wakes it up to forward them
+                    try:
+                        self.wq.put({"cmd":"HTBM"},False)
+                    except Exception as e:
+                        pass
+            else:
+                self._retry+=1
+                self._failover = self.endpoints.failure()
+                self._set_state(DISCONNECTED)
+
+    def _wait_link(self):
+        # block until connected, returning the connection generation
+        self._lock.acquire()
+        while not self.logged:
+            self._link.wait()
+        gen = self._gen
+        self._lock.release()
+        return gen
+
+    def _linked(self,gen):
+        # the stream of connection gen, or None if it has been lost since _wait_link
+        self._lock.acquire()
+        client = self._client if self.logged and gen==self._gen else None
+        self._lock.release()
+        return client
 
     
     def login(self):
         self.log("Trying to connect with uid",self.uid,"and token",self.token)
         self._sock = socket.socket()
         # set keepalive when supported
-        # self._sock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
-        # self._sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPIDLE,20000)
-        # self._sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPINTVL,5)
-        # self._sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPCNT,3)
+        if self.keepalive:
+            try:
+                self._sock.setsockopt(socket.SOL_SOCKET,socket.SO_KEEPALIVE,1)
+                self._sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPIDLE,self.keepalive)
+                self._sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPINTVL,5)
+                self._sock.setsockopt(socket.IPPROTO_TCP,socket.TCP_KEEPCNT,3)
+            except Exception as e:
+                self.log("Keepalive unsupported",e)
         self._client = streams.SocketStream(self._sock)
         try:
-            if not self.ip:
-                self.ip = __builtins__.__default_net["sock"][0].gethostbyname(self.address)
+            i = self.endpoints.pick()
+            self.address = self.endpoints.nodes[i][0]
+            self.port = self.endpoints.nodes[i][1]
+            self.ip = self.endpoints.resolve(i)
+            # connecting and the reply to the login are subject to the read deadline too
+            self._sock.settimeout(self.read_timeout or None)
             self._sock.connect((self.ip,self.port))
+            self._enc = False
+            self._pings = False
         except:
             self.log("Can't connect!")
             self._closeall()
@@ -160,6 +636,10 @@ The Device class
                 "vmuid":vminfo[0],
                 "hearbeat":self.heartbeat,
             }
+            if self.compact:
+                data["enc"] = ["cbor"]
+            if self.ping and self.read_timeout:
+                data["ping"] = self.ping
             try:
                 rec = fota.get_record()
                 data["ota"] = True
@@ -167,6 +647,26 @@ The Device class
                     data["bc"]=rec[4]
                     data["vm"]=rec[1]
                     data["chunk"]=rec[8]
+                data["win"] = self.ota_window
+                data["frm"] = True
+                if self.ota_incremental:
+                    data["icrc"] = True
+                if self.ota_delta:
+                    data["delta"] = True
+                if self.ota_lz:
+                    data["lz"] = self.ota_lz
+                if self.ota!=__OTA_IDLE and self.ota_id is not None:
+                    # an update was interrupted: the ADM can resume it from the first missing block
+                    data["resume"] = {
+                        "id":self.ota_id,
+                        "bc":self.bcslot,
+                        "vm":self.vmslot,
+                        "chunk":self.chunk,
+                        "bcsize":self.bcsize,
+                        "vmsize":self.vmsize,
+                        "t":self.ota_t,
+                        "b":self.cblock
+                    }
             except:
                 data["ota"] = False
 
@@ -178,12 +678,20 @@ The Device class
                 return False
             if "ts" in msg:
                 self.ts = msg["ts"] #current time
+                self._ts_local = timers.now()
             if "htbm" in msg:
                 self.heartbeat = msg["htbm"]
+            if "enc" in msg and msg["enc"]=="cbor" and self.compact:
+                self._enc = True
+            if "ping" in msg and "ping" in data:
+                self._pings = True
             try:
                 fota.accept()
             except:
                 pass
+            if "resume" in msg and self.ota!=__OTA_IDLE:
+                self.log("Resuming OTA at block",self.cblock)
+                self._ota_resume(True)
         except Exception as e:
             self.log("Login exception!",e)
             self._closeall()
@@ -191,43 +699,256 @@ The Device class
         return True
     
     
-    def _reconnect(self):
-        if self.reconnecting:
+    def _reconnect(self,gen=None):
+        # any thread can report a broken link: the first report about the current connection
+        # closes it, waking up the owner thread that will log in again
+        self._lock.acquire()
+        if not self.logged or (gen is not None and gen!=self._gen):
+            self._lock.release()
             return
-        self.reconnecting=True
-        if self.logged:
-            self._closeall()
-            self.logged = False
-        self.start()
+        self.logged = False
+        self.reconnecting = True
+        self._retry = 1
+        self._failover = False
+        self._lock.release()
+        self._closeall()
+        self._set_state(DISCONNECTED)
 
     def _send(self,msg):
         try:
-            bb = json.dumps(msg)
             self.log("Sending",msg)
+            bb = self._sbuf
+            del bb[:]
+            n = self._frame(bb,msg)
             self._client.write(bb)
-            self._client.write("\n")
+            self._last_tx = timers.now()
+            self.stats.tx(n,1)
         except Exception as e:
             self.log("Exception in send",e,msg)
 
-    def send(self,msg):
+    def _send_batch(self,msg,client=None):
+        # serialize msg and the messages already waiting in the queue into a single write,
+        # to client or to the current stream
+        if client is None:
+            client = self._client
+        # only the writer sends batches, _send has its own buffer: it also runs during login,
+        # while the writer may still be writing to the old link
+        parts = self._wbuf
+        del parts[:]
+        n = 0
+        deadline = timers.now()+self.batch_wait
+        while True:
+            n+=1
+            self.log("Sending",msg)
+            self._frame(parts,msg)
+            if len(parts)>=self.batch_size:
+                break
+            try:
+                timeout = deadline-timers.now()
+                if timeout>0:
+                    msg = self.wq.get(timeout=timeout)
+                else:
+                    msg = self.wq.get(False)
+            except QueueEmpty:
+                break
+        client.write(parts)
+        self._last_tx = timers.now()
+        self.stats.tx(len(parts),n)
+
+    def _frame(self,buf,msg):
+        # append msg to buf with the compact encoding, or as a JSON line if the ADM did not
+        # accept it or msg can't be encoded. Returns the number of bytes appended
+        n = len(buf)
+        if self._enc:
+            try:
+                _cbor_frame(buf,msg)
+                return len(buf)-n
+            except ValueError:
+                pass
+        buf.extend(json.dumps(msg).encode("utf-8"))
+        buf.append(10)
+        return len(buf)-n
+
+    def _put(self,msg):
+        # replies and requests produced by the device itself can outpace the writer
+        # (block requests, busy RPC replies): wait for room in the queue instead of failing
+        self.wq.put(msg,True,10000)
+
+    def send(self,msg,key=None):
         """
-.. method:: send(msg)
+.. method:: send(msg,key=None)
 
         Send a raw message to the ADM. :samp:`msg` is a dictionary that will be serialized to JSON and sent.
+        :samp:`key` is passed to the queue of outgoing messages (see :samp:`KEEP_LATEST`).
                 
         """        
-        self.wq.put(msg,False,1000)
+        if key is None:
+            # any queue with the put of queue.Queue can be used
+            self.wq.put(msg,False,1000)
+        else:
+            self.wq.put(msg,False,1000,key)
     
     
-    def _getmsg(self):
+    def _getmsg(self,line=None):
         self.log("Getting message")
-        line = self._client.readline()
-        self.log("Got message",line)
+        if line is None:
+            line = self._client.read(1)
         if not line:
             raise IOError
+        if line[0]==__FRAME_BC or line[0]==__FRAME_VM:
+            return self._getframe(line[0])
+        if line[0]==__FRAME_CBOR:
+            hdr = self._cbor_hdr
+            self._readinto(hdr,2)
+            n = (hdr[0]<<8)|hdr[1]
+            # decoded straight from the stream, without reading the frame into a buffer first
+            self._cbor_left = n
+            try:
+                msg = self._cbor_item(self._ota_buf)
+            except ValueError as e:
+                # an item the device can't decode: the frame length is known, so the link
+                # is still in sync once the rest of the frame is skipped
+                self.log("Skipping compact frame",e)
+                while self._cbor_left:
+                    self._cbor_in(hdr,min(self._cbor_left,len(hdr)))
+                msg = {}
+            if self._cbor_left:
+                # the frame does not hold a single item: the stream can't be trusted any more
+                raise IOError
+            self.stats.rx(n+3)
+            if "raw" in msg:
+                self.log("Got OTA block",len(msg["raw"]))
+            else:
+                self.log("Got message",msg)
+            return msg
+        line = line+self._client.readline()
+        self.stats.rx(len(line))
         msg = json.loads(line)
+        if "bin" in msg:
+            # do not print whole blocks
+            self.log("Got OTA block",len(msg["bin"]))
+        else:
+            self.log("Got message",line)
+        return msg
+
+    def _cbor_in(self,buf,n):
+        # read n bytes of the current compact frame
+        if n>self._cbor_left:
+            raise IOError
+        self._cbor_left-=n
+        self._readinto(buf,n)
+
+    def _cbor_item(self,raw=None):
+        # decode the next item of the current compact frame (a CBOR subset, see _cbor_enc).
+        # raw is the update buffer, used only for the "raw" value of an OTA message (a block):
+        # other byte strings must not be overwritten by the next block
+        hdr = self._cbor_hdr
+        self._cbor_in(hdr,1)
+        major = hdr[0]>>5
+        n = hdr[0]&31
+        if major==7:
+            if n==20:
+                return False
+            if n==21:
+                return True
+            if n==22:
+                return None
+            if n>=25 and n<=27:
+                # half, single and double precision floats
+                k = 1<<(n-24)
+                self._cbor_in(hdr,k)
+                x = 0
+                for j in range(k):
+                    x = (x<<8)|hdr[j]
+                return _cbor_ieee(x,(5,8,11)[n-25],(10,23,52)[n-25])
+            raise ValueError
+        if n>=24:
+            if n>27:
+                raise ValueError
+            k = 1<<(n-24)
+            self._cbor_in(hdr,k)
+            n = 0
+            for j in range(k):
+                n = (n<<8)|hdr[j]
+        if major==0:
+            return n
+        if major==1:
+            return -1-n
+        if major>=2 and major<=5 and n>self._cbor_left:
+            # lengths come from the wire: never allocate past the end of the frame
+            raise IOError
+        if major==2:
+            buf = raw
+            if buf is None or n>len(buf):
+                buf = bytearray(n)
+            self._cbor_in(buf,n)
+            if n<len(buf):
+                # the last block of an image
+                buf = buf[:n]
+            return buf
+        if major==3:
+            if n<=len(hdr):
+                self._cbor_in(hdr,n)
+                # keys and values of OTA blocks are decoded without allocating
+                for name in _cbor_names:
+                    if len(name)==n:
+                        j = 0
+                        while j<n and ord(name[j])==hdr[j]:
+                            j+=1
+                        if j==n:
+                            return name
+                return bytes(hdr[:n]).decode("utf-8")
+            buf = bytearray(n)
+            self._cbor_in(buf,n)
+            return buf.decode("utf-8")
+        if major==4:
+            obj = []
+            for j in range(n):
+                obj.append(self._cbor_item())
+            return obj
+        if major==5:
+            obj = {}
+            for j in range(n):
+                k = self._cbor_item()
+                obj[k] = self._cbor_item(raw if k=="raw" and obj.get("cmd")=="OTA" else None)
+            return obj
+        if major==6 and n==4:
+            # decimal fraction [exponent,mantissa]
+            x = self._cbor_item()
+            if x[0]<0:
+                return x[1]/(10**-x[0])
+            return float(x[1]*10**x[0])
+        raise ValueError
+
+    def _getframe(self,ftype):
+        # blocks are read into the update buffer and returned in the same message dict,
+        # so that receiving a block does not allocate memory
+        hdr = self._ota_hdr
+        self._readinto(hdr,4)
+        n = (hdr[2]<<8)|hdr[3]
+        buf = self._ota_buf
+        if buf is None or n>len(buf):
+            buf = bytearray(n)
+        self._readinto(buf,n)
+        if n<len(buf):
+            # the last block of an image
+            buf = buf[:n]
+        self.stats.rx(n+5)
+        self.log("Got frame",ftype,"block",(hdr[0]<<8)|hdr[1],"size",n)
+        msg = self._ota_msg
+        msg["t"] = "b" if ftype==__FRAME_BC else "v"
+        msg["b"] = (hdr[0]<<8)|hdr[1]
+        msg["raw"] = buf
         return msg
 
+    def _readinto(self,buf,n):
+        r = 0
+        while r<n:
+            k = self._client.readinto(buf,n-r,r)
+            if not k:
+                raise IOError
+            r+=k
+
     def _closeall(self):
         try:
             self._sock.close()
@@ -236,212 +957,635 @@ The Device class
     
     def _htbm(self):
         while True:
-            while self.reconnecting:
-                sleep(1000)
-            self.log("Sleeping for",self.heartbeat)
-            sleep(1000*self.heartbeat)
+            gen = self._wait_link()
+            # any message sent in the meantime postpones the heartbeat
+            idle = 1000*self.heartbeat-(timers.now()-self._last_tx)
+            if idle>0:
+                self.log("Sleeping for",idle)
+                sleep(idle)
+                continue
             try:
                 self.send({"cmd":"HTBM"})
+                self._last_tx = timers.now()
             except:
                 self.log("Exception in htbm")
-                self._reconnect()
+                self._reconnect(gen)
 
     def _writeloop(self):
+        # the writer may wait for a message longer than the connection lasts: a message taken
+        # from the queue after the link was lost is kept and sent after the next login
+        msg = None
         while True:
-            while self.reconnecting:
-                sleep(1000)
+            gen = self._wait_link()
             try:
-                msg = self.wq.get()
-                self._send(msg)
+                if msg is None:
+                    if self.store is None or not self.store.count:
+                        # an empty store needs no wake ups: see _connect for events stored meanwhile
+                        msg = self.wq.get()
+                    else:
+                        try:
+                            msg = self.wq.get(timeout=self._fwd_ms)
+                        except QueueEmpty:
+                            client = self._linked(gen)
+                            if client is not None:
+                                self._forward(client)
+                            continue
+                client = self._linked(gen)
+                if client is None:
+                    continue
+                batch = msg
+                msg = None
+                self._send_batch(batch,client)
+                # the backlog goes along with live messages, at its own rate
+                self._forward(client)
             except Exception as e:
                 self.log("Exception in writeloop",e)
-                self._reconnect()
+                self._reconnect(gen)
 
     def _writeloop_htbm(self):
-        _last_htb = timers.now()
+        msg = None
         while True:
-            while self.reconnecting:
-                sleep(1000)
+            gen = self._wait_link()
             try:
-                try:
-                    timeout = 1000*self.heartbeat - (timers.now() - _last_htb)
-                    if timeout <= 0:
-                        raise QueueEmpty
-                    msg = self.wq.get(timeout = timeout)
-                except QueueEmpty:
-                    self._send({"cmd":"HTBM"})
-                    _last_htb = timers.now()
-                else:
-                    self._send(msg)
+                if msg is None:
+                    try:
+                        timeout = 1000*self.heartbeat - (timers.now() - self._last_tx)
+                        if timeout <= 0:
+                            raise QueueEmpty
+                        if self.store is not None and self.store.count:
+                            timeout = min(timeout,self._fwd_ms)
+                        msg = self.wq.get(timeout = timeout)
+                    except QueueEmpty:
+                        client = self._linked(gen)
+                        if client is not None and not self._forward(client) and timers.now()-self._last_tx>=1000*self.heartbeat:
+                            # a failed write must reach _reconnect, or the loop would retry it at once
+                            self._send_batch({"cmd":"HTBM"},client)
+                        continue
+                client = self._linked(gen)
+                if client is None:
+                    continue
+                batch = msg
+                msg = None
+                self._send_batch(batch,client)
+                self._forward(client)
             except Exception as e:
                 self.log("Exception in writeloop+htbm",e)
-                self._reconnect()
+                self._reconnect(gen)
+
+    def _forward(self,client=None):
+        # send the oldest stored event, at most store_rate per second
+        if self.store is None or not self.store.count or timers.now()-self._fwd_t<self._fwd_ms:
+            return False
+        removed = self.store.removed
+        msg = self.store.peek()
+        if msg is not None:
+            self._send_batch(msg,client)
+        # the event leaves the store only once written to the socket
+        self.store.pop(removed)
+        self._fwd_t = timers.now()
+        return True
+
+    def _ota_send(self,payload,direct=False):
+        if direct:
+            # during login, before the writer is running again
+            self._send({"cmd":"OTA","payload":payload})
+        else:
+            self._put({"cmd":"OTA","payload":payload})
 
     def _ota_fail(self,reason):
-        self.send({"cmd":"OTA","payload":{"ko":1,"reason":reason}})
+        self.ota = __OTA_IDLE
+        self._ota_buf = None
+        self.ota_same = None
+        self._lz = None
+        self._ota_send({"ko":1,"reason":reason})
+
+    def _ota_part(self,t):
+        # start receiving the bytecode ("b") or vm ("v") image
+        self.ota_t = t
+        if t=="b":
+            self.ota = __OTA_RECEIVING_BC
+            self.ota_addr = self.next_bcaddr
+            self.ota_size = self.bcsize
+        else:
+            self.ota = __OTA_RECEIVING_VM
+            self.ota_addr = self.next_vmaddr
+            self.ota_size = self.vmsize
+        self.nblocks = (self.ota_size+self.chunk-1)//self.chunk
+        self.ota_z = 0
+        if self.ota_zinfo is not None:
+            self.ota_z = self.ota_zinfo[2] if t=="b" else self.ota_zinfo[3]
+        if self.ota_z:
+            # blocks are pieces of the compressed stream, decoded into chunks of the image
+            self.nblocks = (self.ota_z+self.chunk-1)//self.chunk
+            self.ota_ob = 0 # next chunk of the image to write
+            self._lz.reset(self.ota_size)
+        self.cblock = 0 # blocks 0..cblock-1 are written
+        self.nblock = 0 # next block to request
+        self.ota_ooo = [] # blocks written out of order, all above cblock
+        self.ota_crc = 0
+        self.ota_erased = 0 if self.ota_erase else self.ota_size # bytes of the slot ready to be written
+        self.ota_same = None
+        self.ota_known = self.nblocks # blocks whose source (ADM or running slot) is known
+        self.ota_hashed = 0 # blocks whose crc has been reported
+        self.ota_hlimit = 0 # blocks whose crc can be reported
+        if self.ota_cur is not None:
+            if t=="b":
+                self.cur_addr = self.ota_cur[5]
+                size = self.ota_cur[6]
+            else:
+                self.cur_addr = self.ota_cur[2]
+                size = self.ota_cur[3]
+            # only blocks entirely inside the running slot can be copied
+            self.ota_hlimit = self.nblocks if self.ota_size<=size else size//self.chunk
+            if self.ota_hlimit:
+                self.ota_same = bytearray((self.nblocks+7)//8)
+                self.ota_known = 0
+        self._ota_hashes()
+        self._ota_fill()
+
+    def _ota_resume(self,direct=False):
+        # requests in flight were lost with the connection; blocks already
+        # written out of order are skipped again when they arrive
+        self.nblock = self.cblock
+        self.ota_hashed = min(self.ota_hashed,self.ota_known)
+        self._ota_hashes(direct)
+        self._ota_fill(direct)
+
+    def _ota_cur_block(self,b):
+        # block b of the running slot, as long as block b of the new image
+        n = min(self.chunk,self.ota_size-b*self.chunk)
+        buf = self._ota_buf if n==self.chunk else bytearray(n)
+        fota.read_slot(self.cur_addr+b*self.chunk,buf)
+        return buf
+
+    def _ota_hashes(self,direct=False):
+        # report the crcs of the next blocks of the running slot, one message at a time:
+        # the ADM answers with the unchanged ones and the next message is sent then
+        if self.ota_hashed>self.ota_known or self.ota_hashed>=self.ota_hlimit:
+            return
+        b = self.ota_hashed
+        h = []
+        try:
+            for i in range(b,min(b+__OTA_HASHES,self.ota_hlimit)):
+                h.append(_block_crc(i,self._ota_cur_block(i)))
+        except Exception as e:
+            # the running slot can't be read: the rest of the image is transferred
+            self.log("Can't read running slot",e)
+            self.ota_hlimit = b
+            self.ota_known = self.nblocks
+            return
+        self._ota_send({"t":self.ota_t,"o":b,"h":h},direct)
+        self.ota_hashed+=len(h)
+
+    def _ota_unchanged(self,o,d):
+        # d is a hex string with a bit for each block reported from o, set when unchanged
+        if o!=self.ota_known or o>=self.ota_hashed:
+            return
+        for i in range(len(d)//2):
+            b = o+i*8
+            if b>=self.ota_hashed:
+                break
+            bits = int(d[i*2:i*2+2],16)
+            if self.ota_hashed-b<8:
+                bits&=(1<<(self.ota_hashed-b))-1
+            # messages start at multiples of __OTA_HASHES: bytes of d are bytes of ota_same
+            self.ota_same[b>>3] = bits
+        self.ota_known = self.ota_hashed if self.ota_hashed<self.ota_hlimit else self.nblocks
+        self._ota_hashes()
+        self._ota_fill()
+
+    def _ota_prepare(self,end):
+        # prepare the flash up to end, while the requested blocks are on their way
+        end = min(end,self.ota_size)
+        while self.ota_erased<end:
+            self.log("ERASE",hex(self.ota_addr+self.ota_erased),self.ota_erase)
+            fota.erase_slot(self.ota_addr+self.ota_erased,self.ota_erase)
+            self.ota_erased+=self.ota_erase
+
+    def _ota_fill(self,direct=False):
+        # request every block that fits in the window, with a single message.
+        # Unchanged blocks of a delta update are copied instead, as soon as they enter the window
+        same = self.ota_same
+        while True:
+            if self.cblock>=self.nblocks:
+                if self.ota_z and not self._lz.finish():
+                    self._ota_fail("Bad stream")
+                    return
+                #ask for crc
+                self.ota = __OTA_RECEIVING_BC_CRC if self.ota_t=="b" else __OTA_RECEIVING_VM_CRC
+                self._ota_send({"c":0,"t":self.ota_t},direct)
+                return
+            end = min(self.cblock+self.ota_win,self.ota_known)
+            b = self.nblock
+            if b>=end:
+                return
+            if same is None or not (same[b>>3]>>(b&7))&1:
+                break
+            self.nblock+=1
+            self._ota_prepare(self.nblock*self.chunk)
+            if b not in self.ota_ooo:
+                self.stats.ota_copied+=1
+                self._ota_write(b,self._ota_cur_block(b))
+        n = 1
+        while b+n<end and (same is None or not (same[(b+n)>>3]>>((b+n)&7))&1):
+            n+=1
+        if n==1:
+            self._ota_send({"b":b,"t":self.ota_t},direct)
+        else:
+            self._ota_send({"b":b,"n":n,"t":self.ota_t},direct)
+        self.nblock+=n
+        if not self.ota_z:
+            # compressed images are erased as they are decoded
+            self._ota_prepare(self.nblock*self.chunk)
+
+    def _ota_flash(self,b,thebin):
+        # write block b of the image and add it to the digest
+        self.log("WRITING BLOCK",b,"at",self.ota_addr+self.chunk*b,len(thebin))
+        fota.write_slot(self.ota_addr+self.chunk*b,thebin)
+        self.stats.ota_block(len(thebin))
+        if self.ota_icrc:
+            self.ota_crc^=_block_crc(b,thebin)
+
+    def _ota_out(self,buf):
+        # a chunk decoded from a compressed image
+        b = self.ota_ob
+        self._ota_prepare((b+1)*self.chunk)
+        self._ota_flash(b,buf)
+        self.ota_ob+=1
+
+    def _ota_write(self,b,thebin):
+        self._ota_flash(b,thebin)
+        if b==self.cblock:
+            self.cblock+=1
+            while self.cblock in self.ota_ooo:
+                self.ota_ooo.remove(self.cblock)
+                self.cblock+=1
+        else:
+            self.ota_ooo.append(b)
+
+    def _ota_block(self,b,thebin):
+        if b<self.cblock or b>=self.nblock or b in self.ota_ooo:
+            self.log("Skipping OTA block",b)
+            return
+        if self.ota_z:
+            if b!=self.cblock:
+                # the stream is decoded in order: blocks arriving early are requested again
+                self.log("Skipping OTA block",b)
+                self.nblock = b
+                return
+            self._lz.feed(thebin)
+            self.cblock+=1
+            self._ota_fill()
+            return
+        self._ota_write(b,thebin)
+        #keep sending blocks or ask for crc
+        self._ota_fill()
+
+    def _ota_check(self,msg):
+        if self.ota_icrc and "icrc" in msg:
+            if int(msg["icrc"],16)!=self.ota_crc:
+                self.log("Bad crc!")
+                return False
+            if not self.ota_full_crc or "crc" not in msg:
+                return True
+        # full slot checksum
+        chk = fota.checksum_slot(self.ota_addr,self.ota_size)
+        if not chk:
+            self.log("Skipping CRC")
+        for i,b in enumerate(chk):
+            k = int(msg["crc"][i*2:i*2+2],16)
+            if k!=b:
+                self.log("Bad crc!")
+                return False
+        return True
     
-    def _readloop(self):
+    def _rpcloop(self):
         while True:
-            while self.reconnecting:
-                sleep(1000)
-            try:
-                msg = self._getmsg()
-                if "cmd" in msg and msg["cmd"]=="CALL" and "method" in msg and msg["method"] in self.rpc and "id" in msg:
-                    if "args" in msg:
-                        args=msg["args"]
-                    else:
-                        args=[]
-                    
-                    ret = False
-                    if "ret" in msg:
-                        ret = msg["ret"]
-                    try:
-                        self.log("calling",msg["method"])
-                        res = self.rpc[msg["method"]](*args)
-                        #print(timers.now(),"called",msg["method"])
-                    except Exception as e:
-                        self.log("Exception in rpc",e)
-                        if ret:
-                            self.send({"cmd":"RETN","id":msg["id"],"error":str(e)})
-                    else:
-                        if ret:
-                            self.send({"cmd":"RETN","id":msg["id"],"res":res})
-                    res=None
-                elif "terminate" in msg:
-                    self.log("Terminating...")
-                    self._closeall()
-                elif "cmd" in msg and msg["cmd"]=="OTA":
-                    self.log("OTA message")
-                    try:
-                        rec = fota.get_record()
-                    except:
-                        self.log("OTA unsupported")
-                        self._ota_fail("OTA unsupported")
-                        continue
+            call = self._rpcq.get()
+            self._rpc_call(call)
+            call = None
 
-                    if "chunk" in msg:
-                        self.chunk = msg["chunk"]
-                        self.vmsize = msg["vmsize"]
-                        self.bcsize = msg["bcsize"]
-                        self.bcslot = msg["bc"]
-                        self.vmslot = msg["vm"]
+    def _rpc_call(self,call):
+        tm = None
+        if self.rpc_timeout and call[0] in self.rpc_timeout:
+            tm = timers.timer()
+            tm.one_shot(self.rpc_timeout[call[0]],self._rpc_expired,call)
+        try:
+            self.log("calling",call[0])
+            if call[0]=="__stats" and self.stats_rpc:
+                res = self.stats.get()
+            else:
+                res = self.rpc[call[0]](*call[1])
+        except Exception as e:
+            self.log("Exception in rpc",e)
+            self._rpc_reply(call,"error",str(e))
+        else:
+            self._rpc_reply(call,"res",res)
+        if tm:
+            tm.clear()
 
-                        if self.bcslot==rec[4] or (self.vmsize and self.vmslot==rec[1]):
-                            self.log("Invalid OTA request!")
-                            self._ota_fail("Bad slots")
-                            continue
+    def _rpc_expired(self,call):
+        self.log("RPC timeout",call[0])
+        self._rpc_reply(call,"error","timeout",True)
 
-                        if self.vmsize<=0:
-                            self.ota_type = __OTA_ONLY_BC
-                            self.next_bcaddr = fota.find_bytecode_slot()
-                            self.next_vmaddr = -1
-                        else:
-                            self.ota_type = __OTA_BC_AND_VM
-                            self.next_vmaddr = fota.find_vm_slot()
-                            self.next_bcaddr = fota.find_bytecode_slot()
+    def _rpc_reply(self,call,key,value,expired=False):
+        # the first of result and timeout is sent, the other is discarded
+        self._rpc_lock.acquire()
+        done = call[4]
+        call[4] = True
+        self._rpc_lock.release()
+        if call[6] is not None and not (done and expired):
+            # a retry of the call gets the same answer; a result arriving after the timeout
+            # replaces it, so that retries get the result the caller is waiting for
+            e = call[6]
+            e[3] = value
+            e[4] = timers.now()
+            e[2] = key
+        if done:
+            return
+        self.stats.rpc_time(call[0],timers.now()-call[5])
+        if not call[3]:
+            return
+        try:
+            self._put({"cmd":"RETN","id":call[2],key:value})
+        except Exception as e:
+            self.log("Exception in rpc reply",e)
 
-                        if self.fota_callback and not self.fota_callback(0):
-                            self.log("OTA",0,"stopped by callback")
-                            self._ota_fail("stopped by callback")
-                            continue
+    def _live(self):
+        # milliseconds until the link must be checked again, None without pings. A ping is sent
+        # when nothing has been received for ping ms: without an answer the link is broken
+        if not self._pings:
+            return None
+        now = timers.now()
+        idle = now-self._last_rx
+        if idle<self.ping:
+            return self.ping-idle
+        if idle>=self.ping+self.read_timeout:
+            self.log("No answer to ping")
+            self.stats.timeouts+=1
+            raise IOError
+        if self._ping_t<=self._last_rx:
+            self._ping_t = now
+            try:
+                self.send({"cmd":"PING"})
+            except QueueFull:
+                pass
+        return self.ping+self.read_timeout-idle
 
-                        if self.next_bcaddr>0:
-                            self.log("ERASE BC SLOT",hex(self.next_bcaddr), self.bcsize)
-                            fota.erase_slot(self.next_bcaddr, self.bcsize)
-                            
-
-                        if self.next_vmaddr>0:
-                            self.log("ERASE VM SLOT",hex(self.next_vmaddr), self.vmsize)
-                            fota.erase_slot(self.next_vmaddr, self.vmsize)
-
-                        self.ota = __OTA_RECEIVING_BC
-                        self.cblock = 0
-                        self.csize = 0
-                        self.send({"cmd":"OTA","payload":{"b":0,"t":"b"}})
-
-                    elif "bin" in msg and (self.ota==__OTA_RECEIVING_BC or self.ota==__OTA_RECEIVING_VM):
-                        thebin = base64.standard_b64decode(msg["bin"])
-                        if self.ota == __OTA_RECEIVING_BC:
-                            if msg["t"]!="b":
-                                self.log("Bad OTA message!")
-                                self._ota_fail("BC only ota")
-                                continue
-                            addr = self.next_bcaddr
-                            tsize = self.bcsize
-                        elif self.ota == __OTA_RECEIVING_VM and self.ota_type==__OTA_BC_AND_VM:
-                            addr = self.next_bcaddr if msg["t"]=="b" else self.next_vmaddr
-                            tsize = self.bcsize if msg["t"]=="b" else self.vmsize
-
-                        self.log("WRITING BLOCK",self.cblock,"at",hex(addr+self.chunk*self.cblock),len(thebin))
-                        fota.write_slot(addr+self.chunk*self.cblock,thebin)
-                        self.cblock+=1
-                        self.csize+=len(thebin)
-                        if self.csize<tsize:
-                            #keep sending blocks
-                            self.send({"cmd":"OTA","payload":{"b":self.cblock,"t":msg["t"]}})
-                        else:
-                            #ask for crc
-                            self.ota = __OTA_RECEIVING_BC_CRC if msg["t"]=="b" else __OTA_RECEIVING_VM_CRC
-                            self.send({"cmd":"OTA","payload":{"c":0,"t":msg["t"]}})
-                    elif "crc" in msg:
-                        if msg["t"]=="b":
-                            chk = fota.checksum_slot(self.next_bcaddr,self.bcsize)
-                            fota.close_slot(self.next_bcaddr)
-                        else:
-                            chk = fota.checksum_slot(self.next_vmaddr,self.vmsize)
-                            fota.close_slot(self.next_vmaddr)
-                        if not chk:
-                            self.log("Skipping CRC")
-                        
-                        for i,b in enumerate(chk):
-                            k = int(msg["crc"][i*2:i*2+2],16)
-                            if k!=b:
-                                self.log("Bad crc!")
-                                self._ota_fail("Bad CRC")
-                                break
-                        else:
-                            self.log("OTA OK")
-                            if msg["t"]=="b" and self.ota_type==__OTA_BC_AND_VM:
-                                #start VM download
-                                self.send({"cmd":"OTA","payload":{"b":0,"t":"v"}})
-                                self.ota = __OTA_RECEIVING_VM
-                                self.cblock = 0
-                                self.csize = 0
-                                self.log("Vm begin")
-                            else:
-                                # try OTA!
-                                if self.fota_callback and not self.fota_callback(1):
-                                    self.log("OTA",1,"stopped by callback")
-                                    self._ota_fail("stopped by callback")
-                                    continue
-                                fota.attempt(self.bcslot,self.vmslot)
-                                if self.fota_callback and not self.fota_callback(2):
-                                    self.log("OTA",2,"stopped by callback")
-                                    self._ota_fail("stopped by callback")
-                                    continue
-                                self._closeall()
-                                self.log("resetting...")
-                                sleep(1000)
-                                mcu.reset()
-                    elif "ok" in msg:
-                        if msg["bc"] == rec[4] and msg["vm"] == rec[1]:
-                            self.send({"cmd":"OTA","payload":{"ok":1}})
-                        else:
-                            self._ota_fail("not ready")
+    def _wait_msg(self,wait):
+        # first byte of the next message, or None after wait ms (None: no limit)
+        self._sock.settimeout(None if wait is None else max(wait,1))
+        try:
+            line = self._client.read(1)
+        except TimeoutError:
+            line = None
+        else:
+            self._last_rx = timers.now()
+        # the rest of the message must follow within the read deadline
+        self._sock.settimeout(self.read_timeout or None)
+        return line
+
+    def _readloop(self):
+        while True:
+            self._connect()
+            try:
+                line = self._wait_msg(self._live())
+                if line is not None:
+                    self._handle(self._getmsg(line))
             except Exception as e:
                 self.log("Exception in readloop",e)
                 self._reconnect()
-        
-        
-        
-    def send_event(self,payload):
+
+    def _loop(self):
+        # single thread mode: reads, writes and heartbeats are multiplexed with socket timeouts
+        while True:
+            self._connect()
+            try:
+                self._step(self.poll)
+            except Exception as e:
+                self.log("Exception in loop",e)
+                self._reconnect()
+
+    def _step(self,wait):
+        self._step_rx(self._step_tx(wait))
+
+    def _step_tx(self,wait):
+        # send the heartbeat if the link has been idle long enough, or what is waiting in the queue.
+        # Returns how long the next read can wait
+        live = self._live()
+        if live is not None:
+            wait = min(wait,live)
+        if timers.now()-self._last_tx>=1000*self.heartbeat:
+            self._send_batch({"cmd":"HTBM"})
+        else:
+            try:
+                msg = self.wq.get(False)
+            except QueueEmpty:
+                msg = None
+            if msg is not None:
+                self._send_batch(msg)
+                msg = None
+                # more messages are likely to follow: just peek at the socket
+                wait = 1
+            if self.store is not None and self.store.count:
+                # the backlog goes along with live messages, at its own rate
+                self._forward()
+                # wake up in time for the next stored event
+                wait = min(wait,self._fwd_ms)
+        return wait
+
+    def _step_rx(self,wait):
+        # wait for the first byte of an incoming message, at most until the next heartbeat
+        line = self._wait_msg(min(wait,1000*self.heartbeat-(timers.now()-self._last_tx)))
+        if line is not None:
+            self._handle(self._getmsg(line))
+
+    def _handle(self,msg):
+        if "cmd" in msg and msg["cmd"]=="CALL" and "method" in msg and (msg["method"] in self.rpc or (msg["method"]=="__stats" and self.stats_rpc)) and "id" in msg:
+            if "args" in msg:
+                args=msg["args"]
+            else:
+                args=[]
+            
+            ret = False
+            if "ret" in msg:
+                ret = msg["ret"]
+            # method, args, id, ret, answered, time of arrival, cache entry
+            call = [msg["method"],args,msg["id"],ret,False,timers.now(),None]
+            if self._rpc_cache is not None:
+                e = self._rpc_cache.get(msg["id"],msg["method"])
+                if e is not None:
+                    self.stats.rpc_hits+=1
+                    if e[2] is None:
+                        self.log("RPC already running",msg["id"])
+                    elif ret:
+                        self._put({"cmd":"RETN","id":msg["id"],e[2]:e[3]})
+                    return
+                self.stats.rpc_misses+=1
+                call[6] = self._rpc_cache.add(msg["id"],msg["method"])
+            if self._rpcq is None:
+                self._rpc_call(call)
+            else:
+                try:
+                    self._rpcq.put(call,False)
+                except QueueFull:
+                    self.log("RPC queue full")
+                    self.stats.rpc_busy+=1
+                    if call[6] is not None:
+                        # not executed: a retry must run it
+                        self._rpc_cache.remove(call[6])
+                    if ret:
+                        self._put({"cmd":"RETN","id":msg["id"],"error":"busy"})
+            call=None
+        elif "terminate" in msg:
+            self.log("Terminating...")
+            self._closeall()
+        elif "cmd" in msg and msg["cmd"]=="OTA":
+            if ("bin" in msg or "raw" in msg) and (self.ota==__OTA_RECEIVING_BC or self.ota==__OTA_RECEIVING_VM):
+                # blocks come first and skip the fota record, to keep their path short
+                if msg["t"]!=self.ota_t:
+                    self.log("Bad OTA message!")
+                    self._ota_fail("BC only ota" if self.ota_type==__OTA_ONLY_BC else "Bad OTA block")
+                    return
+                if "raw" in msg:
+                    thebin = msg["raw"]
+                else:
+                    thebin = base64.standard_b64decode(msg["bin"])
+                # ADMs without window support do not tag blocks with their index
+                self._ota_block(msg["b"] if "b" in msg else self.cblock,thebin)
+                return
+            if "d" in msg and self.ota_same is not None and (self.ota==__OTA_RECEIVING_BC or self.ota==__OTA_RECEIVING_VM) and msg["t"]==self.ota_t:
+                self._ota_unchanged(msg["o"],msg["d"])
+                return
+            self.log("OTA message")
+            try:
+                rec = fota.get_record()
+            except:
+                self.log("OTA unsupported")
+                self._ota_fail("OTA unsupported")
+                return
+
+            if "chunk" in msg:
+                if "win" in msg:
+                    self.ota_win = max(1,min(msg["win"],self.ota_window))
+                else:
+                    self.ota_win = 1
+                if self.ota!=__OTA_IDLE and self.ota_id is not None and "id" in msg and self.ota_id==msg["id"] and self.chunk==msg["chunk"] and self.bcsize==msg["bcsize"] and self.vmsize==msg["vmsize"] and self.bcslot==msg["bc"] and self.vmslot==msg["vm"]:
+                    # the same images started again: keep what is already in flash
+                    self.log("Resuming OTA at block",self.cblock)
+                    self._ota_resume()
+                    return
+                self.chunk = msg["chunk"]
+                # identifies the images: an update of other images of the same size starts over
+                self.ota_id = msg["id"] if "id" in msg else None
+                self.stats.ota_begin()
+                # one buffer receives all the blocks of the update: allocate it on a clean heap
+                self._ota_buf = None
+                gc.collect()
+                self._ota_buf = bytearray(self.chunk)
+                # the ADM will send the digest of the blocks in the crc message
+                self.ota_icrc = "icrc" in msg
+                # the ADM will send only the blocks changed from the running slots
+                self.ota_cur = rec if "delta" in msg and self.ota_delta and rec[0] else None
+                # the ADM compresses the images: [w,l,compressed bc size,compressed vm size]
+                self.ota_zinfo = None
+                self._lz = None
+                if "lz" in msg:
+                    z = msg["lz"]
+                    if self.ota_cur is not None or len(z)!=4 or not (4<=z[0]<=self.ota_lz) or not (3<=z[1]<z[0]):
+                        # compressed blocks must not be written to flash as image data
+                        self.log("Invalid OTA compression",z)
+                        self._ota_fail("Bad compression")
+                        return
+                    self.ota_zinfo = z
+                    self._lz = _LzDecoder(z[0],z[1],bytearray(self.chunk),self._ota_out)
+                self.vmsize = msg["vmsize"]
+                self.bcsize = msg["bcsize"]
+                self.bcslot = msg["bc"]
+                self.vmslot = msg["vm"]
+
+                if self.bcslot==rec[4] or (self.vmsize and self.vmslot==rec[1]):
+                    self.log("Invalid OTA request!")
+                    self._ota_fail("Bad slots")
+                    return
+
+                if self.vmsize<=0:
+                    self.ota_type = __OTA_ONLY_BC
+                    self.next_bcaddr = fota.find_bytecode_slot()
+                    self.next_vmaddr = -1
+                else:
+                    self.ota_type = __OTA_BC_AND_VM
+                    self.next_vmaddr = fota.find_vm_slot()
+                    self.next_bcaddr = fota.find_bytecode_slot()
+
+                if self.fota_callback and not self.fota_callback(0):
+                    self.log("OTA",0,"stopped by callback")
+                    self._ota_fail("stopped by callback")
+                    return
+
+                if self.next_bcaddr>0 and not self.ota_erase:
+                    self.log("ERASE BC SLOT",hex(self.next_bcaddr), self.bcsize)
+                    fota.erase_slot(self.next_bcaddr, self.bcsize)
+                    
+
+                if self.next_vmaddr>0 and not self.ota_erase:
+                    self.log("ERASE VM SLOT",hex(self.next_vmaddr), self.vmsize)
+                    fota.erase_slot(self.next_vmaddr, self.vmsize)
+
+                self._ota_part("b")
+
+            elif ("crc" in msg or "icrc" in msg) and (self.ota==__OTA_RECEIVING_BC_CRC or self.ota==__OTA_RECEIVING_VM_CRC):
+                ok = self._ota_check(msg)
+                fota.close_slot(self.ota_addr)
+                if not ok:
+                    self._ota_fail("Bad CRC")
+                else:
+                    self.log("OTA OK")
+                    if msg["t"]=="b" and self.ota_type==__OTA_BC_AND_VM:
+                        #start VM download
+                        self.log("Vm begin")
+                        self._ota_part("v")
+                    else:
+                        # try OTA!
+                        if self.fota_callback and not self.fota_callback(1):
+                            self.log("OTA",1,"stopped by callback")
+                            self._ota_fail("stopped by callback")
+                            return
+                        fota.attempt(self.bcslot,self.vmslot)
+                        if self.fota_callback and not self.fota_callback(2):
+                            self.log("OTA",2,"stopped by callback")
+                            self._ota_fail("stopped by callback")
+                            return
+                        self._closeall()
+                        self.log("resetting...")
+                        sleep(1000)
+                        mcu.reset()
+            elif "ok" in msg:
+                if msg["bc"] == rec[4] and msg["vm"] == rec[1]:
+                    self._ota_send({"ok":1})
+                else:
+                    self._ota_fail("not ready")
+
+    def send_event(self,payload,key=None):
         """
-.. method:: send_event(payload)
+.. method:: send_event(payload,key=None)
 
         Send an event message containing the payload :samp:`payload` to the ADM. Payload is given as a dictionary and then serialized to JSON.
+        If the event class of the queue has the :samp:`KEEP_LATEST` policy, an event with the same :samp:`key` still waiting to be sent is replaced by this one.
+        The queue may also limit the rate of the events of a :samp:`key` (see :class:`OutQueue`): for example :samp:`OutQueue(policies=(BLOCK,KEEP_LATEST),limits={"temp":(1,1)})` sends at most one :samp:`"temp"` event per second, the latest.
+        With a :samp:`store`, the event is stored while the device is not connected, or instead of raising an exception when the queue is full.
                 
         """
-        self.send({"cmd":"EVNT","payload":payload})
+        msg = {"cmd":"EVNT","payload":payload}
+        if self.store is None:
+            self.send(msg,key)
+        elif not self.logged:
+            self.store.put(msg)
+        else:
+            try:
+                self.send(msg,key)
+            except QueueFull:
+                self.store.put(msg)
         
         
     def send_notification(self,title,text):
@@ -452,7 +1596,735 @@ The Device class
                 
         """
         self.send({"cmd":"NTFY","payload":{"text":text,"title":title}})
+
+    def send_events(self,payloads):
+        """
+.. method:: send_events(payloads)
+
+        Send a list of event payloads to the ADM with a single message, in the format described for :class:`EventBatcher`. All the payloads get the current time.
+                
+        """
+        dt = timers.now()-self._ts_local
+        records = []
+        for payload in payloads:
+            records.append([dt,payload])
+        self.send({"cmd":"EVNB","ts":self.ts,"payload":records})
+
+    def event_batcher(self,size=16,age=5000):
+        """
+.. method:: event_batcher(size=16,age=5000)
+
+        Returns a new :class:`EventBatcher` collecting events for this device.
+                
+        """
+        return EventBatcher(self,size,age)
+
+
+class EventBatcher():
+    """
+======================
+The EventBatcher class
+======================
+
+.. class:: EventBatcher(device,size=16,age=5000)
+
+        Collects event payloads for :samp:`device` together with the time they were added, and sends them to the ADM with a single message when :samp:`size` payloads have been collected or the oldest one has been waiting for :samp:`age` milliseconds.
+
+        Batches are sent as :samp:`{"cmd":"EVNB","ts":ts,"payload":[[dt,payload],...]}` where :samp:`ts` is the time value received from the ADM at login and each :samp:`dt` is the number of milliseconds elapsed from :samp:`ts` to the moment the :samp:`payload` was added. The time of the event is therefore :samp:`ts+dt`; :samp:`dt` is negative for events added before the last reconnection.
+
+        If a batch can't be queued it is kept and sent together with the next one. Up to :samp:`2*size` payloads are kept: older ones are discarded and counted in :samp:`dropped`.
+
+    """
+    def __init__(self,device,size=16,age=5000):
+        self.device = device
+        self.size = size
+        self.age = age
+        self.records = []
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._tm = timers.timer()
+
+    def add(self,payload):
+        """
+.. method:: add(payload)
+
+        Adds an event payload to the batch, sending the batch if full. The payload is kept even if the batch can't be queued: it is sent again with the next batch or when the oldest payload reaches :samp:`age`.
         
-    
-        
+        """
+        self._lock.acquire()
+        self.records.append([timers.now(),payload])
+        if len(self.records)>2*self.size:
+            self.records.pop(0)
+            self.dropped+=1
+        n = len(self.records)
+        self._lock.release()
+        if n>=self.size:
+            try:
+                self.flush()
+            except Exception as e:
+                # the payload is stored: raising would make the application add it twice
+                self.device.log("Exception in batch",e)
+        elif n==1 and self.age>0:
+            self._tm.one_shot(self.age,self._expired)
+
+    def _expired(self,arg=None):
+        try:
+            self.flush()
+        except Exception as e:
+            self.device.log("Exception in batch",e)
+
+    def flush(self):
+        """
+.. method:: flush()
+
+        Sends the collected payloads now. Raises :samp:`QueueFull` if the batch can't be queued, keeping the payloads and trying again after :samp:`age` milliseconds.
         
+        """
+        self._lock.acquire()
+        records = self.records
+        self.records = []
+        self._lock.release()
+        if not records:
+            return
+        self._tm.clear()
+        d = self.device
+        batch = []
+        for r in records:
+            batch.append([r[0]-d._ts_local,r[1]])
+        try:
+            d.send({"cmd":"EVNB","ts":d.ts,"payload":batch})
+        except Exception as e:
+            self._lock.acquire()
+            self.records = records+self.records
+            self._lock.release()
+            if self.age>0:
+                self._tm.one_shot(self.age,self._expired)
+            raise e
+
+
+class EventStore():
+    """
+====================
+The EventStore class
+====================
+
+.. class:: EventStore(size=32,policy=DROP_OLDEST,record=128)
+
+        Keeps up to :samp:`size` event messages in RAM while they can't be sent, to be forwarded by a :class:`Device` when connected again (see the :samp:`store` parameter of :class:`Device`).
+        Events are stored as JSON in a ring of :samp:`size` records of :samp:`record` bytes, allocated once: the store never takes more than :samp:`size*record` bytes. Events longer than :samp:`record` bytes are discarded and counted in :samp:`dropped`.
+        When full, :samp:`policy` selects which event is discarded: the oldest stored one (:samp:`DROP_OLDEST`) or the new one (:samp:`DROP_NEWEST`). Discarded events are counted in :samp:`dropped`.
+
+        :samp:`count` is the number of stored events, :samp:`removed` the number of events that left the store, sent or discarded.
+
+    """
+    def __init__(self,size=32,policy=DROP_OLDEST,record=128):
+        self.size = size
+        self.policy = policy
+        self.record = record
+        self.head = 0
+        self.count = 0
+        self.removed = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._init()
+
+    def _init(self):
+        self._ring = bytearray(self.size*self.record)
+
+    def _encode(self,msg):
+        # the record stored for msg, or None if it can't be stored
+        bb = json.dumps(msg).encode("utf-8")
+        if len(bb)>self.record:
+            return None
+        return bb
+
+    def _write(self,i,rec):
+        if rec is None:
+            return
+        ring = self._ring
+        i*=self.record
+        n = len(rec)
+        ring[i:i+n] = rec
+        # padding is ignored by the JSON parser
+        for j in range(i+n,i+self.record):
+            ring[j] = 32
+
+    def _read(self,i):
+        i*=self.record
+        try:
+            return json.loads(bytes(self._ring[i:i+self.record]).decode("utf-8"))
+        except Exception as e:
+            return None
+
+    def _sync(self):
+        pass
+
+    def put(self,msg):
+        """
+.. method:: put(msg)
+
+        Stores :samp:`msg` applying the policy when full. Returns False if :samp:`msg` has been discarded.
+
+        """
+        rec = self._encode(msg)
+        self._lock.acquire()
+        try:
+            if rec is None:
+                # checked before making room, so that no stored event is lost for it
+                self.dropped+=1
+                return False
+            if self.count>=self.size:
+                self.dropped+=1
+                if self.policy==DROP_NEWEST:
+                    return False
+                self.head = (self.head+1)%self.size
+                self.count-=1
+                self.removed+=1
+            self._write((self.head+self.count)%self.size,rec)
+            self.count+=1
+            self._sync()
+            return True
+        finally:
+            self._lock.release()
+
+    def peek(self):
+        """
+.. method:: peek()
+
+        Returns the oldest stored event, or None.
+
+        """
+        self._lock.acquire()
+        try:
+            if not self.count:
+                return None
+            return self._read(self.head)
+        finally:
+            self._lock.release()
+
+    def pop(self,removed=None):
+        """
+.. method:: pop(removed=None)
+
+        Removes the oldest stored event. If :samp:`removed` is given, the event is removed only if no event left the store since :samp:`removed` was read, i.e. it is still the one returned by a previous :meth:`peek`.
+
+        """
+        self._lock.acquire()
+        try:
+            if not self.count or (removed is not None and removed!=self.removed):
+                return
+            self._write(self.head,None)
+            self.head = (self.head+1)%self.size
+            self.count-=1
+            self.removed+=1
+            self._sync()
+        finally:
+            self._lock.release()
+
+
+class FileEventStore(EventStore):
+    """
+========================
+The FileEventStore class
+========================
+
+.. class:: FileEventStore(path,size=256,record=128,policy=DROP_OLDEST)
+
+        An :class:`EventStore` keeping events in the file :samp:`path`, so that they survive a reset. The file is a ring of :samp:`size` records of :samp:`record` bytes each, preceded by a header with the position of the oldest event and the number of events: its size never exceeds :samp:`(size+1)*record` bytes.
+        Events are stored as JSON: those longer than :samp:`record-1` bytes are discarded and counted in :samp:`dropped`.
+        Events already in the file are kept when the store is created again on the same file with the same :samp:`size` and :samp:`record`.
+
+    """
+    def __init__(self,path,size=256,record=128,policy=DROP_OLDEST):
+        self.path = path
+        EventStore.__init__(self,size,policy,record)
+
+    def _init(self):
+        try:
+            self._file = open(self.path,"r+")
+            hdr = self._file.read(self.record).split()
+            self.head = int(hdr[0])%self.size
+            self.count = min(int(hdr[1]),self.size)
+        except Exception as e:
+            self._file = open(self.path,"w+")
+            self.head = 0
+            self.count = 0
+            self._sync()
+
+    def _encode(self,msg):
+        bb = json.dumps(msg)
+        if len(bb)>=self.record:
+            return None
+        return bb+" "*(self.record-len(bb)-1)+"\n"
+
+    def _write(self,i,rec):
+        if rec is None:
+            return
+        self._file.seek((i+1)*self.record)
+        self._file.write(rec)
+
+    def _read(self,i):
+        self._file.seek((i+1)*self.record)
+        try:
+            return json.loads(self._file.read(self.record))
+        except Exception as e:
+            return None
+
+    def _sync(self):
+        hdr = str(self.head)+" "+str(self.count)
+        self._file.seek(0)
+        self._file.write(hdr+" "*(self.record-len(hdr)-1)+"\n")
+        self._file.flush()
+
+
+def _msg_class(msg):
+    if "cmd" in msg and (msg["cmd"]=="EVNT" or msg["cmd"]=="EVNB" or msg["cmd"]=="NTFY"):
+        return 1
+    return 0
+
+class OutQueue():
+    """
+==================
+The OutQueue class
+==================
+
+.. class:: OutQueue(sizes=(4,2),policies=(BLOCK,BLOCK),classify=None,limits=None)
+
+        Creates the queue of outgoing messages of a :class:`Device`. Messages are divided in priority classes, class 0 being the most urgent, and each class has its own capacity and overflow policy.
+        A message of a class is sent only when all the classes before it are empty.
+
+        * :samp:`sizes` is a tuple with the maximum number of messages waiting in each class
+        * :samp:`policies` is a tuple with the overflow policy of each class:
+
+            * :samp:`BLOCK`, the sender waits for room in the class (or gets an exception if it can't wait)
+            * :samp:`DROP_OLDEST`, the oldest message of the class is discarded to make room
+            * :samp:`DROP_NEWEST`, the new message is discarded
+            * :samp:`KEEP_LATEST`, a message sent with a key replaces the one with the same key still waiting in the class. Without a matching key the oldest message of the class is discarded to make room
+
+        * :samp:`classify` is a function returning the class of a message. By default events and notifications are in class 1, while RPC results, heartbeats and FOTA messages are in class 0.
+        * :samp:`limits` is a dictionary of token buckets limiting the rate of messages leaving the queue. Keys are message keys (as given to :samp:`put`) or commands (as :samp:`"EVNT"` or :samp:`"NTFY"`), values are :samp:`(rate,burst)` tuples: at most :samp:`rate` messages per second, with up to :samp:`burst` of them sent back to back after a quiet period. A message is limited by the bucket of its key if there is one, otherwise by the bucket of its command. Limited messages wait in their class, the following ones of other buckets go ahead of them, and messages of class 0 are never limited, so that RPC results and FOTA messages are not delayed by a busy application. With the :samp:`KEEP_LATEST` policy a limited message is replaced by a newer one with the same key, so that at most :samp:`rate` values per second of each key are sent, always the latest.
+
+        Discarded messages are counted in the :samp:`drops` list, one counter per class.
+
+        Any object with the same :samp:`put` and :samp:`get` methods can be used as queue of a :class:`Device`.
+
+    """
+    def __init__(self,sizes=(4,2),policies=(BLOCK,BLOCK),classify=None,limits=None):
+        self.sizes = sizes
+        self.policies = policies
+        self.classify = classify if classify else _msg_class
+        # token buckets: [interval in ms, capacity in ms, available ms, time of the last refill]
+        self.limits = None
+        if limits:
+            self.limits = {}
+            for k in limits:
+                rate,burst = limits[k]
+                interval = int(1000/rate)
+                self.limits[k] = [interval,interval*burst,interval*burst,timers.now()]
+        self.items = []
+        self.keys = []
+        self.drops = []
+        for c in range(len(sizes)):
+            self.items.append([])
+            self.keys.append([])
+            self.drops.append(0)
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def put(self,msg,block=True,timeout=-1,key=None):
+        """
+.. method:: put(msg,block=True,timeout=-1,key=None)
+
+        Adds :samp:`msg` to its class, applying the class overflow policy when full. With the :samp:`BLOCK` policy, :samp:`block` and :samp:`timeout` (in milliseconds) work as in :samp:`queue.Queue` and :samp:`QueueFull` is raised when the message can't be queued.
+        :samp:`key` identifies the message for the :samp:`KEEP_LATEST` policy.
+
+        """
+        c = self.classify(msg)
+        items = self.items[c]
+        keys = self.keys[c]
+        policy = self.policies[c]
+        self._lock.acquire()
+        try:
+            if policy==KEEP_LATEST and key is not None and key in keys:
+                items[keys.index(key)] = msg
+                return
+            if len(items)>=self.sizes[c]:
+                if policy==BLOCK:
+                    if not block:
+                        raise QueueFull
+                    deadline = timers.now()+timeout
+                    while len(items)>=self.sizes[c]:
+                        if timeout<0:
+                            self._not_full.wait()
+                        elif deadline<=timers.now():
+                            raise QueueFull
+                        else:
+                            self._not_full.wait(deadline-timers.now())
+                elif policy==DROP_NEWEST:
+                    self.drops[c]+=1
+                    return
+                else:
+                    items.pop(0)
+                    keys.pop(0)
+                    self.drops[c]+=1
+            items.append(msg)
+            keys.append(key)
+            self._not_empty.notify()
+        finally:
+            self._lock.release()
+
+    def get(self,block=True,timeout=-1):
+        """
+.. method:: get(block=True,timeout=-1)
+
+        Removes and returns the first message of the most urgent non empty class, skipping the messages over their rate limit. :samp:`QueueEmpty` is raised if no message is available within :samp:`timeout` milliseconds.
+
+        """
+        self._lock.acquire()
+        try:
+            deadline = timers.now()+timeout
+            while True:
+                wake = -1
+                for c in range(len(self.items)):
+                    if not self.items[c]:
+                        continue
+                    if c==0 or self.limits is None:
+                        i = 0
+                    else:
+                        i,wait = self._next(c)
+                        if i<0:
+                            if wake<0 or wait<wake:
+                                wake = wait
+                            continue
+                    self.keys[c].pop(i)
+                    msg = self.items[c].pop(i)
+                    self._not_full.notify_all()
+                    return msg
+                if not block:
+                    raise QueueEmpty
+                if timeout>=0:
+                    left = deadline-timers.now()
+                    if left<=0:
+                        raise QueueEmpty
+                    if wake<0 or left<wake:
+                        wake = left
+                # limited messages: wake up when the first bucket has a token again
+                if wake<0:
+                    self._not_empty.wait()
+                else:
+                    self._not_empty.wait(wake)
+        finally:
+            self._lock.release()
+
+    def _next(self,c):
+        # index of the first message of class c within its rate limit, taking a token for it,
+        # or -1 and the milliseconds until one of the limited messages can go
+        items = self.items[c]
+        keys = self.keys[c]
+        now = timers.now()
+        wait = -1
+        seen = []
+        for i in range(len(items)):
+            if keys[i] is not None and keys[i] in self.limits:
+                k = keys[i]
+            elif "cmd" in items[i] and items[i]["cmd"] in self.limits:
+                k = items[i]["cmd"]
+            else:
+                return i,0
+            if k in seen:
+                # keep the order of the messages of a bucket
+                continue
+            b = self.limits[k]
+            b[2] = min(b[1],b[2]+now-b[3])
+            b[3] = now
+            if b[2]>=b[0]:
+                b[2]-=b[0]
+                return i,0
+            seen.append(k)
+            if wait<0 or b[0]-b[2]<wait:
+                wait = b[0]-b[2]
+        return -1,wait
+
+    def qsize(self):
+        n = 0
+        for items in self.items:
+            n+=len(items)
+        return n
+
+
+class Histogram():
+    """
+===================
+The Histogram class
+===================
+
+.. class:: Histogram(bounds)
+
+        Counts values in buckets: bucket :samp:`i` holds values lower than :samp:`bounds[i]` and not in the buckets before it, while the last bucket holds values greater than or equal to :samp:`bounds[-1]`.
+        The number of values, their sum and the maximum are kept in :samp:`n`, :samp:`sum` and :samp:`max`.
+
+    """
+    def __init__(self,bounds):
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds)+1)
+        self.n = 0
+        self.sum = 0
+        self.max = 0
+
+    def add(self,v):
+        """
+.. method:: add(v)
+
+        Adds the value :samp:`v`.
+
+        """
+        i = 0
+        for b in self.bounds:
+            if v<b:
+                break
+            i+=1
+        self.counts[i]+=1
+        self.n+=1
+        self.sum+=v
+        if v>self.max:
+            self.max = v
+
+    def get(self):
+        """
+.. method:: get()
+
+        Returns a dictionary with bounds, bucket counts, number, sum and maximum of the values.
+
+        """
+        return {"bounds":self.bounds,"counts":self.counts,"n":self.n,"sum":self.sum,"max":self.max}
+
+
+class Stats():
+    """
+===============
+The Stats class
+===============
+
+.. class:: Stats(device)
+
+        Collects the statistics of :samp:`device`, available as :samp:`device.stats`. Counters are plain attributes and can be read at any time:
+
+        * :samp:`tx_bytes`, :samp:`tx_msgs`, :samp:`tx_writes`, bytes, messages and socket writes sent
+        * :samp:`rx_bytes`, :samp:`rx_msgs`, bytes and messages received
+        * :samp:`batch`, a :class:`Histogram` of the number of messages sent with each write, i.e. of the depth of the queue when the writer takes messages from it
+        * :samp:`reconnects`, :samp:`reconnect_ms`, the number of connections established again after being lost and the milliseconds spent without connection meanwhile; :samp:`timeouts` counts the connections dropped because a ping was not answered
+        * :samp:`rpc`, a dictionary with a :class:`Histogram` of the latency of the calls (milliseconds from arrival to result) for each RPC method; :samp:`rpc_busy` counts the calls refused because all workers were busy; with :samp:`rpc_cache`, :samp:`rpc_hits` and :samp:`rpc_misses` count the calls answered from the cache (or ignored while running) and the ones executed
+        * :samp:`ota_blocks`, :samp:`ota_bytes`, :samp:`ota_ms`, blocks and bytes written by the current or last FOTA update and milliseconds from its start to the last block written; :samp:`ota_copied` counts the blocks of a delta update copied from the running slot instead of transferred
+
+        Counters are updated without locks: they are meant for monitoring, not accounting.
+
+    """
+    def __init__(self,device):
+        self.device = device
+        self.tx_bytes = 0
+        self.tx_msgs = 0
+        self.tx_writes = 0
+        self.rx_bytes = 0
+        self.rx_msgs = 0
+        self.batch = Histogram((2,4,8,16))
+        self.reconnects = 0
+        self.reconnect_ms = 0
+        self.timeouts = 0
+        self.rpc = {}
+        self.rpc_busy = 0
+        self.rpc_hits = 0
+        self.rpc_misses = 0
+        self.ota_blocks = 0
+        self.ota_bytes = 0
+        self.ota_ms = 0
+        self.ota_copied = 0
+        self._down = -1 # time the connection was lost
+        self._ota_t0 = 0
+
+    def tx(self,nbytes,nmsgs):
+        self.tx_bytes+=nbytes
+        self.tx_msgs+=nmsgs
+        self.tx_writes+=1
+        self.batch.add(nmsgs)
+
+    def rx(self,nbytes):
+        self.rx_bytes+=nbytes
+        self.rx_msgs+=1
+
+    def rpc_time(self,method,ms):
+        if method not in self.rpc:
+            self.rpc[method] = Histogram((10,100,1000,10000))
+        self.rpc[method].add(ms)
+
+    def ota_begin(self):
+        self.ota_blocks = 0
+        self.ota_bytes = 0
+        self.ota_ms = 0
+        self.ota_copied = 0
+        self._ota_t0 = timers.now()
+
+    def ota_block(self,nbytes):
+        self.ota_blocks+=1
+        self.ota_bytes+=nbytes
+        self.ota_ms = timers.now()-self._ota_t0
+
+    def _state(self,old,new):
+        if old==CONNECTED:
+            self._down = timers.now()
+        elif new==CONNECTED and self._down>=0:
+            self.reconnects+=1
+            self.reconnect_ms+=timers.now()-self._down
+            self._down = -1
+
+    def get(self):
+        """
+.. method:: get()
+
+        Returns all the statistics in a dictionary, together with the FOTA blocks written per second (:samp:`ota_bps`), the current depth of the queue of outgoing messages (:samp:`queue`), the messages discarded by its classes (:samp:`drops`) and the events discarded by the store (:samp:`store_drops`).
+
+        """
+        d = self.device
+        rpc = {}
+        for m in self.rpc:
+            rpc[m] = self.rpc[m].get()
+        res = {
+            "tx_bytes":self.tx_bytes,
+            "tx_msgs":self.tx_msgs,
+            "tx_writes":self.tx_writes,
+            "rx_bytes":self.rx_bytes,
+            "rx_msgs":self.rx_msgs,
+            "batch":self.batch.get(),
+            "reconnects":self.reconnects,
+            "reconnect_ms":self.reconnect_ms,
+            "timeouts":self.timeouts,
+            "rpc":rpc,
+            "rpc_busy":self.rpc_busy,
+            "rpc_hits":self.rpc_hits,
+            "rpc_misses":self.rpc_misses,
+            "ota_blocks":self.ota_blocks,
+            "ota_bytes":self.ota_bytes,
+            "ota_copied":self.ota_copied,
+            "ota_bps":self.ota_blocks*1000//self.ota_ms if self.ota_ms else 0
+        }
+        if isinstance(d.wq,OutQueue):
+            res["queue"] = d.wq.qsize()
+            res["drops"] = d.wq.drops
+        if d.store is not None:
+            res["store_drops"] = d.store.dropped
+        return res
+
+
+class Endpoints():
+    """
+===================
+The Endpoints class
+===================
+
+.. class:: Endpoints(endpoints,ttl=300000)
+
+        Keeps the ADM nodes a :class:`Device` can connect to and chooses the one to use for each connection attempt. :samp:`endpoints` is a list of :samp:`(address,port)` tuples, where the address is a hostname or an ip address.
+
+        Hostnames are resolved only when needed and the address is reused for :samp:`ttl` milliseconds, or until a connection attempt to it fails. Each endpoint has a health score: the number of consecutive failed attempts and the average time taken by the successful ones.
+        A failed endpoint is skipped for a while, doubling at each failure up to a minute, and the healthiest endpoint available is chosen, staying on the current one while it works: after a failure the next endpoint is tried, and the one that fails is not tried again until the others fail too.
+
+        The state of each endpoint is in :samp:`nodes`, a list of :samp:`[address,port,ip,expiry,fails,ms,skip_until]`, with :samp:`ms` negative until the first success. :samp:`lookups` counts the hostname resolutions.
+
+    """
+    def __init__(self,endpoints,ttl=300000):
+        self.ttl = ttl
+        self.nodes = []
+        for e in endpoints:
+            # ip addresses need no resolution
+            ip = e[0]
+            for c in ip:
+                if c not in "0123456789.":
+                    ip = None
+                    break
+            self.nodes.append([e[0],e[1],ip,-1,0,-1,0])
+        self.cur = 0
+        self.lookups = 0
+        self._t0 = 0
+
+    def pick(self):
+        """
+.. method:: pick()
+
+        Chooses the endpoint of the next connection attempt and returns its index.
+
+        """
+        now = timers.now()
+        best = -1
+        for i in range(len(self.nodes)):
+            n = self.nodes[i]
+            if best<0:
+                best = i
+                continue
+            b = self.nodes[best]
+            # skipped endpoints last, then fewer failures, then known to work, then faster
+            if (n[6]>now)!=(b[6]>now):
+                better = b[6]>now
+            elif n[6]>now:
+                better = n[6]<b[6]
+            elif n[4]!=b[4]:
+                better = n[4]<b[4]
+            elif (n[5]<0)!=(b[5]<0):
+                better = b[5]<0
+            else:
+                better = n[5]<b[5]
+            if better:
+                best = i
+        # stay on the current endpoint unless another is healthier
+        c = self.nodes[self.cur]
+        b = self.nodes[best]
+        if c[6]<=now and c[4]==b[4] and (c[5]>=0 or b[5]<0):
+            best = self.cur
+        self.cur = best
+        self._t0 = now
+        return best
+
+    def resolve(self,i):
+        """
+.. method:: resolve(i)
+
+        Returns the ip address of endpoint :samp:`i`, resolving its hostname if the cached address is missing or expired.
+
+        """
+        n = self.nodes[i]
+        if n[2] is None or (n[3]>=0 and timers.now()>=n[3]):
+            self.lookups+=1
+            n[2] = __builtins__.__default_net["sock"][0].gethostbyname(n[0])
+            n[3] = timers.now()+self.ttl
+        return n[2]
+
+    def success(self):
+        """
+.. method:: success()
+
+        Records a successful connection to the endpoint returned by the last :samp:`pick`.
+
+        """
+        n = self.nodes[self.cur]
+        ms = timers.now()-self._t0
+        n[5] = ms if n[5]<0 else (n[5]*3+ms)//4
+        n[4] = 0
+        n[6] = 0
+
+    def failure(self):
+        """
+.. method:: failure()
+
+        Records a failed connection attempt to the endpoint returned by the last :samp:`pick`. Returns True if another endpoint is ready to be tried at once.
+
+        """
+        n = self.nodes[self.cur]
+        n[4]+=1
+        n[6] = timers.now()+min(60000,1000<<min(n[4]-1,6))
+        if n[3]>=0:
+            # resolve again: the node may have moved
+            n[2] = None
+        now = timers.now()
+        for m in self.nodes:
+            if m[4]==0 and m[6]<=now:
+                return True
+        return False